@@ -1,9 +1,14 @@
 import streamlit as st
 import os
-import pandas as pd
-from logic import ContentGenerator
+import time
+from logic import BytesLRU, ClientRegistry, ContentGenerator, ContextCache, GenerationLog, ImageCache, ImagePostProcessor, MetricsRecorder, PromptCache, RequestScheduler, ZipExporter
 from datetime import datetime
 
+run_started = time.perf_counter()
+
+# Formats that can be derived locally from a generated 1:1 image
+DERIVED_FORMATS = ["9:16", "16:9", "4:5", "3:2"]
+
 # Page Config
 st.set_page_config(
     page_title="Nano Banana Automator",
@@ -30,6 +35,20 @@ with st.sidebar:
     image_model_id = st.selectbox("Modelo de Imagen", options=image_model_options, index=0)
     
     output_dir = st.text_input("Carpeta de Salida", value="output")
+    max_parallel_images = st.slider("Imágenes en paralelo", min_value=1, max_value=8, value=4,
+                                    help="Número máximo de imágenes que se generan a la vez con 'Generar Todas'.")
+    use_image_cache = st.checkbox("Usar caché de imágenes", value=True,
+                                  help="Reutiliza imágenes ya generadas con el mismo prompt, modelo y formato sin llamar a la API.")
+    optimize_images = st.checkbox("Optimizar PNG en segundo plano", value=False,
+                                  help="Recomprime sin pérdida cada imagen guardada para reducir su tamaño.")
+    use_context_cache = st.checkbox("Caché de contexto (instrucciones + guía)", value=True,
+                                    help="Guarda en Gemini el prefijo fijo del prompt para no reenviarlo en cada brief.")
+    edit_on_regenerate = st.checkbox("Regenerar editando la imagen", value=True,
+                                     help="Envía la imagen actual junto con la corrección para que el modelo la edite en lugar de crear una nueva.")
+    derive_with_api = st.checkbox("Usar la API si el recorte corta texto", value=False,
+                                  help="Al derivar formatos, genera con el modelo de imagen los que no se puedan recortar sin cortar texto, en lugar de rellenarlos con el fondo de marca.")
+    force_refresh_prompts = st.checkbox("Forzar nuevos prompts", value=False,
+                                        help="Ignora los prompts guardados para este brief y vuelve a llamar al modelo de texto.")
     
     if st.button("Limpiar Galería"):
         if 'generated_content' in st.session_state:
@@ -58,54 +77,366 @@ with col1:
 if 'generated_content' not in st.session_state:
     st.session_state.generated_content = None
 
+@st.cache_resource
+def get_generation_log(log_dir):
+    # Shared log per folder; imports a legacy generation_log.csv the first time
+    generation_log = GenerationLog(log_dir)
+    generation_log.migrate_csv()
+    return generation_log
+
+@st.cache_resource
+def get_zip_exporter():
+    return ZipExporter()
+
+def log_generation(log_entry):
+    # Appends a single entry to the generation log in the output folder
+    log_entry["brief_hash"] = GenerationLog.brief_hash(st.session_state.get('brief_used', ''))
+    get_generation_log(output_dir).append(log_entry)
+
+@st.cache_resource
+def get_client_registry():
+    # Process-wide GenAI clients, so reruns reuse connections instead of reconnecting
+    return ClientRegistry()
+
+@st.cache_resource
+def get_post_processor():
+    # One worker pool per process for thumbnails (and optional PNG optimization), outside the script run
+    return ImagePostProcessor()
+
+@st.cache_resource
+def get_file_bytes():
+    # Encoded image bytes shared across reruns, so the gallery doesn't re-read files
+    return BytesLRU()
+
+@st.cache_resource
+def get_metrics():
+    # Process-wide call metrics (latency, bytes, tokens) for the sidebar and exports
+    return MetricsRecorder()
+
+@st.cache_resource
+def get_scheduler():
+    # Shared by every session: limiters are kept per API key and model, not per browser tab
+    return RequestScheduler()
+
+@st.cache_resource
+def get_context_cache():
+    # Cached-content handles for the static prompt prefix, shared by every session (keyed per API key)
+    return ContextCache()
+
+@st.cache_resource
+def get_image_cache(cache_dir):
+    # One cache instance per folder, shared across reruns and sessions
+    return ImageCache(cache_dir)
+
+@st.cache_resource
+def get_prompt_cache(cache_dir):
+    return PromptCache(cache_dir)
+
 # Initialize Generator if key is present
 generator = None
 if api_key:
     try:
-        generator = ContentGenerator(api_key, text_model_id, image_model_id)
+        generator = ContentGenerator(api_key, text_model_id, image_model_id, registry=get_client_registry())
+        if use_image_cache:
+            generator.image_cache = get_image_cache(os.path.join(output_dir, ".cache", "images"))
+        generator.prompt_cache = get_prompt_cache(os.path.join(output_dir, ".cache", "prompts"))
+        generator.post_processor = get_post_processor()
+        generator.optimize_images = optimize_images
+        generator.hooks.append(get_metrics())
+        generator.scheduler = get_scheduler()
+        if use_context_cache:
+            generator.context_cache = get_context_cache()
     except Exception as e:
         st.error(f"Error initializing generator: {e}")
 
+if generator and generator.image_cache is not None:
+    cache_stats = generator.image_cache.stats()
+    st.sidebar.caption(
+        f"🗄️ Caché: {cache_stats['hits']} aciertos / {cache_stats['misses']} fallos · "
+        f"{cache_stats['entries']} imágenes ({cache_stats['bytes'] / (1024 * 1024):.1f} MB)"
+    )
+
+def init_post_state(post_idx, post):
+    # Initialize the generated_images_data entry for a single post
+    st.session_state.generated_images_data[post_idx] = {
+        'id': post['id'],
+        'concept': post['concept'],
+        'description': post['description'],
+        'options': []
+    }
+    for i, prompt_data in enumerate(post['options']):
+        prompt = prompt_data.get('prompt', str(prompt_data)) if isinstance(prompt_data, dict) else str(prompt_data)
+        st.session_state.generated_images_data[post_idx]['options'].append({
+            'original_prompt': prompt,
+            'current_prompt': prompt,
+            'path': None,
+            'filename': None,
+            'status': 'pending',
+            'message': 'Pendiente - Presiona "Generar Imagen"',
+            'version': 1,
+            'history': [],
+            'derived': {}
+        })
+
+def count_generated():
+    return sum(
+        1 for post_data in st.session_state.generated_images_data.values()
+        for opt in post_data['options']
+        if opt['status'] == 'generated'
+    )
+
+# Card button callbacks. They run before the card re-executes, so the card never needs an
+# explicit st.rerun(scope="fragment"), which fails when Streamlit merges the click into a full-app run.
+def generate_option(generator, post_idx, i):
+    post_data = st.session_state.generated_images_data[post_idx]
+    option_data = post_data['options'][i]
+    img_filename = f"post_{post_data['id']}_opt_{i+1}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
+    img_path = os.path.join(output_dir, img_filename)
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    first_image = count_generated() == 0
+    success, msg = generator.generate_image(option_data['current_prompt'], img_path)
+
+    if success:
+        option_data.update({
+            'path': img_path,
+            'filename': img_filename,
+            'status': 'generated',
+            'message': 'Generado'
+        })
+
+        # Log generation
+        log_generation({
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "brief_snippet": st.session_state.get('brief_used', '')[:30],
+            "post_id": post_data['id'],
+            "concept": post_data['concept'],
+            "option_num": i+1,
+            "prompt": option_data['current_prompt'],
+            "file_path": img_path
+        })
+
+        st.toast(f"✅ Imagen generada para Post {post_data['id']}, Opción {i+1}")
+        # The ZIP section only appears once there is an image; it lives outside this card
+        st.session_state.needs_full_rerun = first_image
+    else:
+        option_data.update({
+            'status': 'error',
+            'message': msg
+        })
+        st.toast(f"❌ Error al generar: {msg}")
+
+def derive_option_formats(generator, post_idx, i):
+    post_data = st.session_state.generated_images_data[post_idx]
+    option_data = post_data['options'][i]
+    formats = st.session_state.get(f"formats_{post_data['id']}_{i+1}", [])
+    for aspect_ratio, success, msg, derived_path in generator.derive_formats(
+            option_data['path'], option_data['current_prompt'], formats, api_fallback=derive_with_api):
+        if success:
+            option_data.setdefault('derived', {})[aspect_ratio] = derived_path
+            log_generation({
+                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "brief_snippet": st.session_state.get('brief_used', '')[:30],
+                "post_id": post_data['id'],
+                "concept": post_data['concept'],
+                "option_num": f"{i+1}_{aspect_ratio}",
+                "prompt": option_data['current_prompt'],
+                "file_path": derived_path
+            })
+        else:
+            st.toast(f"❌ {aspect_ratio}: {msg}")
+
+def regenerate_option(generator, post_idx, i):
+    post_data = st.session_state.generated_images_data[post_idx]
+    option_data = post_data['options'][i]
+    correction_prompt = st.session_state.get(f"input_regen_{post_data['id']}_{i+1}", "")
+    if not correction_prompt:
+        st.toast("⚠️ Ingresa instrucciones de corrección para regenerar.")
+        return
+
+    version = option_data.get('version', 1) + 1
+    # The prompt records every correction applied so far, in order
+    full_correction = f"{option_data['current_prompt']}\n\nCORRECTIONS (v{version}): {correction_prompt}"
+    new_filename = f"post_{post_data['id']}_opt_{i+1}_v{version}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
+    new_path = os.path.join(output_dir, new_filename)
+
+    if edit_on_regenerate:
+        # Edit the current image so earlier corrections are kept
+        regen_success, regen_msg = generator.edit_image(option_data['path'], correction_prompt, new_path)
+    else:
+        regen_success, regen_msg = generator.generate_image(full_correction, new_path)
+
+    if not regen_success:
+        st.toast(f"❌ Error al regenerar: {regen_msg}")
+        return
+
+    # Update session state for the regenerated image, keeping the previous versions
+    option_data.setdefault('history', []).append(
+        {'version': option_data.get('version', 1), 'path': option_data['path']}
+    )
+    option_data.update({
+        'current_prompt': full_correction,
+        'path': new_path,
+        'filename': new_filename,
+        'version': version,
+        'derived': {}, # Formats of the previous version no longer apply
+        'status': 'generated', # Reset status to generated so it shows up
+        'message': f'Imagen regenerada (v{version})'
+    })
+
+    # Log regeneration
+    log_generation({
+        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "brief_snippet": st.session_state.get('brief_used', '')[:30],
+        "post_id": post_data['id'],
+        "concept": post_data['concept'],
+        "option_num": f"{i+1}_v{version}",
+        "prompt": full_correction,
+        "file_path": new_path
+    })
+
+    st.toast("✅ Imagen regenerada y registrada.")
+
+@st.fragment
+def render_option_card(generator, post_idx, i):
+    # One option card; reads and writes only its own slice of generated_images_data
+    if st.session_state.pop('needs_full_rerun', False):
+        st.rerun()
+
+    post_data = st.session_state.generated_images_data[post_idx]
+    option_data = post_data['options'][i]
+
+    st.caption(f"Opción {i+1}")
+    st.code(option_data['current_prompt'], language="text")
+
+    # Button to generate image on-demand
+    if option_data['status'] == 'pending' or option_data['status'] == 'error':
+        st.button("🎨 Generar Imagen", key=f"gen_{post_data['id']}_{i+1}", type="primary",
+                  on_click=generate_option, args=(generator, post_idx, i))
+
+    if option_data['status'] == 'generated' and option_data['path'] and os.path.exists(option_data['path']):
+        # Show the lightweight preview; full resolution only on zoom/download
+        thumb_path = generator.post_processor.thumbnail_path(option_data['path'])
+        preview_path = thumb_path if os.path.exists(thumb_path) else option_data['path']
+        st.image(get_file_bytes().read(preview_path), caption=f"Opción {i+1}", use_container_width=True)
+        if preview_path == thumb_path and st.toggle("🔍 Ampliar", key=f"zoom_{post_data['id']}_{i+1}"):
+            st.image(get_file_bytes().read(option_data['path']), use_container_width=True)
+        st.success(option_data['message'])
+
+        # Individual Download Button (downloading doesn't need to rerun anything)
+        st.download_button(
+            label="⬇️ Descargar",
+            data=get_file_bytes().read(option_data['path']),
+            file_name=option_data['filename'],
+            mime="image/png",
+            key=f"dl_{post_data['id']}_{i+1}",
+            on_click="ignore"
+        )
+
+        # Other formats, derived locally from this image (crop or pad) instead of new generations
+        format_key = f"{post_data['id']}_{i+1}"
+        formats = st.multiselect("Formatos adicionales", DERIVED_FORMATS, key=f"formats_{format_key}")
+        if formats:
+            st.button("📐 Derivar formatos", key=f"derive_{format_key}",
+                      on_click=derive_option_formats, args=(generator, post_idx, i))
+
+        for aspect_ratio, derived_path in option_data.get('derived', {}).items():
+            if os.path.exists(derived_path):
+                st.download_button(
+                    label=f"⬇️ {aspect_ratio}",
+                    data=get_file_bytes().read(derived_path),
+                    file_name=os.path.basename(derived_path),
+                    mime="image/png",
+                    key=f"dl_{format_key}_{aspect_ratio}",
+                    on_click="ignore"
+                )
+
+        # Regeneration UI
+        regen_key = f"regen_{post_data['id']}_{i+1}"
+        st.text_input(
+            "Corrección (opcional)",
+            key=f"input_{regen_key}",
+            placeholder="Ej: Cambia el fondo a azul, agrega más texto..."
+        )
+        st.button("🔄 Regenerar", key=f"btn_{regen_key}",
+                  on_click=regenerate_option, args=(generator, post_idx, i))
+    elif option_data['status'] == 'error':
+        st.error(option_data['message'])
+    elif option_data['status'] == 'pending':
+        st.info("⏳ Presiona '🎨 Generar Imagen'")
+
+@st.fragment
+def render_zip_section():
+    # Own fragment: option cards rerun without it, so any click here re-reads the current session state
+    st.button("🔄 Actualizar resumen", help="Incluye las imágenes generadas desde la última actualización.")
+    generated_count = count_generated()
+
+    if generated_count > 0:
+        st.info(f"📊 {generated_count} imagen(es) generada(s)")
+
+        # Build the archive only on request, from this session's images, in memory
+        session_paths = [
+            path
+            for post_data in st.session_state.generated_images_data.values()
+            for opt in post_data['options']
+            if opt['status'] == 'generated' and opt['path']
+            for path in [opt['path'], *opt.get('derived', {}).values()]
+            if os.path.exists(path)
+        ]
+        session_path_set = set(session_paths)
+        session_log = [
+            record for record in get_generation_log(output_dir).query(brief=st.session_state.get('brief_used', ''))
+            if record.get('file_path') in session_path_set
+        ]
+        extra_files = {"generation_log.csv": get_generation_log(output_dir).to_csv_bytes(session_log)}
+
+        zip_exporter = get_zip_exporter()
+        zip_key = zip_exporter.manifest_hash(session_paths, extra_files)
+        if zip_exporter.has(zip_key) or st.button("📦 Preparar ZIP", help="Empaqueta las imágenes de esta sesión y su registro."):
+            st.download_button(
+                label="📦 DESCARGAR TODO (ZIP)",
+                data=zip_exporter.build(session_paths, extra_files),
+                file_name="nano_banana_output.zip",
+                mime="application/zip",
+                type="primary",
+                help="Descarga todas las imágenes generadas y el registro en un solo archivo.",
+                on_click="ignore"
+            )
+
 # Logic Execution
 if generate_btn and generator and brief:
-    # 1. Generate Prompts
+    # 1. Generate Prompts (streamed: each post is shown as soon as it is complete)
+    st.session_state.generated_content = {'posts': []}
+    st.session_state.results_cache = [] # reset image cache
+    st.session_state.images_generated = False
+    st.session_state.brief_used = brief
+    st.session_state.generated_images_data = {}
+
+    stream_area = st.container()
     with st.spinner("1/2: Analizando brief y diseñando prompts..."):
         try:
             # We use the provided 'guidelines' from the main UI
-            result_json = generator.generate_prompts(brief, guidelines)
-
-            st.session_state.generated_content = result_json
-            st.session_state.results_cache = [] # reset image cache
-            st.session_state.images_generated = False
-            st.session_state.brief_used = brief
-            
-            # Initialize generated_images_data structure
-            st.session_state.generated_images_data = {}
-            posts = result_json.get('posts', [])
-            for post_idx, post in enumerate(posts):
-                st.session_state.generated_images_data[post_idx] = {
-                    'id': post['id'],
-                    'concept': post['concept'],
-                    'description': post['description'],
-                    'options': []
-                }
-                for i, prompt_data in enumerate(post['options']):
-                    prompt = prompt_data.get('prompt', str(prompt_data)) if isinstance(prompt_data, dict) else str(prompt_data)
-                    st.session_state.generated_images_data[post_idx]['options'].append({
-                        'original_prompt': prompt,
-                        'current_prompt': prompt,
-                        'path': None,
-                        'filename': None,
-                        'status': 'pending',
-                        'message': 'Pendiente - Presiona "Generar Imagen"'
-                    })
-            
-            st.success("✅ Prompts generados exitosamente. Ahora puedes generar las imágenes individualmente.")
-            st.rerun()
+            for post_idx, post in enumerate(generator.generate_prompts_stream(brief, guidelines, force_refresh=force_refresh_prompts)):
+                st.session_state.generated_content['posts'].append(post)
+                init_post_state(post_idx, post)
+
+                with stream_area:
+                    post_data = st.session_state.generated_images_data[post_idx]
+                    st.markdown(f"### Post {post_data['id']}: {post_data['concept']}")
+                    st.write(post_data['description'])
+                    for i, option_data in enumerate(post_data['options']):
+                        st.caption(f"Opción {i+1}")
+                        st.code(option_data['current_prompt'], language="text")
         except Exception as e:
+            st.session_state.generated_content = None
             st.error(f"Error generando prompts: {e}")
             st.stop()
 
+    st.success("✅ Prompts generados exitosamente. Ahora puedes generar las imágenes individualmente.")
+    st.rerun()
+
 # Main Processor
 if st.session_state.generated_content and generator:
     posts = st.session_state.generated_content.get('posts', [])
@@ -115,7 +446,58 @@ if st.session_state.generated_content and generator:
     st.subheader("Resultados - Generación Manual de Imágenes")
     st.info("💡 Haz clic en '🎨 Generar Imagen' para crear solo las imágenes que necesites, ahorrando tokens.")
 
-    # Use the data stored in session_state for display
+    # Batch generation of every pending/failed option, with bounded parallelism
+    if 'generated_images_data' in st.session_state:
+        pending_jobs = []
+        for post_idx, post_data in st.session_state.generated_images_data.items():
+            for i, option_data in enumerate(post_data['options']):
+                if option_data['status'] in ('pending', 'error'):
+                    img_filename = f"post_{post_data['id']}_opt_{i+1}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
+                    pending_jobs.append({
+                        'key': (post_idx, i, img_filename),
+                        'prompt': option_data['current_prompt'],
+                        'output_path': os.path.join(output_dir, img_filename)
+                    })
+
+        if pending_jobs and st.button(f"🎨 Generar Todas ({len(pending_jobs)} pendientes)", type="primary"):
+            os.makedirs(output_dir, exist_ok=True)
+            progress = st.progress(0.0, text="Generando imágenes...")
+            live_gallery = st.columns(3)
+            done = 0
+            for (post_idx, i, img_filename), success, msg in generator.generate_images(pending_jobs, max_workers=max_parallel_images):
+                post_data = st.session_state.generated_images_data[post_idx]
+                option_data = post_data['options'][i]
+                img_path = os.path.join(output_dir, img_filename)
+                if success:
+                    option_data.update({
+                        'path': img_path,
+                        'filename': img_filename,
+                        'status': 'generated',
+                        'message': 'Generado'
+                    })
+                    log_generation({
+                        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                        "brief_snippet": st.session_state.get('brief_used', '')[:30],
+                        "post_id": post_data['id'],
+                        "concept": post_data['concept'],
+                        "option_num": i+1,
+                        "prompt": option_data['current_prompt'],
+                        "file_path": img_path
+                    })
+                    # Fill the gallery as each image arrives
+                    with live_gallery[done % 3]:
+                        st.image(img_path, caption=f"Post {post_data['id']} - Opción {i+1}", use_container_width=True)
+                else:
+                    option_data.update({
+                        'status': 'error',
+                        'message': msg
+                    })
+                done += 1
+                progress.progress(done / len(pending_jobs), text=f"Generando imágenes... {done}/{len(pending_jobs)}")
+            st.rerun()
+
+    # Use the data stored in session_state for display; each option card is a fragment,
+    # so its buttons rerun only that card instead of the whole gallery
     if 'generated_images_data' in st.session_state:
         for post_idx, post_data in st.session_state.generated_images_data.items():
             st.markdown(f"### Post {post_data['id']}: {post_data['concept']}")
@@ -123,160 +505,14 @@ if st.session_state.generated_content and generator:
 
             cols = st.columns(3) # Display 3 options side by side
 
-            for i, option_data in enumerate(post_data['options']):
+            for i in range(len(post_data['options'])):
                 with cols[i]:
-                    st.caption(f"Opción {i+1}")
-                    st.code(option_data['current_prompt'], language="text")
-
-                    # Button to generate image on-demand
-                    if option_data['status'] == 'pending' or option_data['status'] == 'error':
-                        if st.button("🎨 Generar Imagen", key=f"gen_{post_data['id']}_{i+1}", type="primary"):
-                            with st.spinner("Generando imagen..."):
-                                img_filename = f"post_{post_data['id']}_opt_{i+1}_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                                img_path = os.path.join(output_dir, img_filename)
-                                
-                                # Ensure output directory exists
-                                os.makedirs(output_dir, exist_ok=True)
-                                
-                                success, msg = generator.generate_image(option_data['current_prompt'], img_path)
-                                
-                                if success:
-                                    st.session_state.generated_images_data[post_idx]['options'][i].update({
-                                        'path': img_path,
-                                        'filename': img_filename,
-                                        'status': 'generated',
-                                        'message': 'Generado'
-                                    })
-                                    
-                                    # Log generation
-                                    log_data = [{
-                                        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        "brief_snippet": st.session_state.get('brief_used', '')[:30],
-                                        "post_id": post_data['id'],
-                                        "concept": post_data['concept'],
-                                        "option_num": i+1,
-                                        "prompt": option_data['current_prompt'],
-                                        "file_path": img_path
-                                    }]
-                                    log_file = os.path.join(output_dir, "generation_log.csv")
-                                    df_new = pd.DataFrame(log_data)
-                                    if os.path.exists(log_file):
-                                        df_old = pd.read_csv(log_file)
-                                        df_final = pd.concat([df_old, df_new], ignore_index=True)
-                                    else:
-                                        df_final = df_new
-                                    df_final.to_csv(log_file, index=False)
-                                    
-                                    st.toast(f"✅ Imagen generada para Post {post_data['id']}, Opción {i+1}")
-                                    st.rerun()
-                                else:
-                                    st.session_state.generated_images_data[post_idx]['options'][i].update({
-                                        'status': 'error',
-                                        'message': msg
-                                    })
-                                    st.error(f"Error al generar: {msg}")
-                                    st.rerun()
-                    
-                    if option_data['status'] == 'generated' and option_data['path'] and os.path.exists(option_data['path']):
-                        st.image(option_data['path'], caption=f"Opción {i+1}", use_container_width=True)
-                        st.success(option_data['message'])
-
-                        # Individual Download Button
-                        with open(option_data['path'], "rb") as file:
-                            st.download_button(
-                                label="⬇️ Descargar",
-                                data=file,
-                                file_name=option_data['filename'],
-                                mime="image/png",
-                                key=f"dl_{post_data['id']}_{i+1}"
-                            )
-
-                        # Regeneration UI
-                        regen_key = f"regen_{post_data['id']}_{i+1}"
-                        correction_prompt = st.text_input(
-                            "Corrección (opcional)",
-                            key=f"input_{regen_key}",
-                            placeholder="Ej: Cambia el fondo a azul, agrega más texto..."
-                        )
-
-                        if st.button("🔄 Regenerar", key=f"btn_{regen_key}"):
-                            if correction_prompt:
-                                full_correction = f"{option_data['original_prompt']}\n\nCORRECTIONS: {correction_prompt}"
-
-                                with st.spinner("Regenerando imagen..."):
-                                    new_filename = f"post_{post_data['id']}_opt_{i+1}_v2_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-                                    new_path = os.path.join(output_dir, new_filename)
-
-                                    regen_success, regen_msg = generator.generate_image(full_correction, new_path)
-
-                                    if regen_success:
-                                        # Update session state for the regenerated image
-                                        st.session_state.generated_images_data[post_idx]['options'][i].update({
-                                            'current_prompt': full_correction,
-                                            'path': new_path,
-                                            'filename': new_filename,
-                                            'status': 'generated', # Reset status to generated so it shows up
-                                            'message': 'Imagen regenerada'
-                                        })
-
-                                        # Log regeneration
-                                        log_file = os.path.join(output_dir, "generation_log.csv")
-                                        log_entry = {
-                                            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                            "brief_snippet": st.session_state.get('brief_used', '')[:30],
-                                            "post_id": post_data['id'],
-                                            "concept": post_data['concept'],
-                                            "option_num": f"{i+1}_v2",
-                                            "prompt": full_correction,
-                                            "file_path": new_path
-                                        }
-                                        df_new = pd.DataFrame([log_entry])
-                                        if os.path.exists(log_file):
-                                            df_old = pd.read_csv(log_file)
-                                            df_final = pd.concat([df_old, df_new], ignore_index=True)
-                                        else:
-                                            df_final = df_new
-                                        df_final.to_csv(log_file, index=False)
-
-                                        st.toast("✅ Imagen regenerada y registrada.")
-                                        st.rerun() # Rerun to display the new image
-                                    else:
-                                        st.error(f"Error al regenerar: {regen_msg}")
-                            else:
-                                st.warning("Ingresa instrucciones de corrección para regenerar.")
-                    elif option_data['status'] == 'error':
-                        st.error(option_data['message'])
-                    elif option_data['status'] == 'pending':
-                        st.info("⏳ Presiona '🎨 Generar Imagen'")
+                    render_option_card(generator, post_idx, i)
 
     st.divider()
 
     # Download ZIP button (visible when images have been generated)
-    generated_count = sum(
-        1 for post_data in st.session_state.generated_images_data.values() 
-        for opt in post_data['options'] 
-        if opt['status'] == 'generated'
-    )
-    
-    if generated_count > 0:
-        st.info(f"📊 {generated_count} imagen(es) generada(s)")
-        
-        # Create ZIP file
-        zip_path = "output_files.zip"
-        if os.path.exists(output_dir):
-            import shutil
-            shutil.make_archive("output_files", 'zip', output_dir)
-        
-        if os.path.exists(zip_path):
-            with open(zip_path, "rb") as fp:
-                st.download_button(
-                    label="📦 DESCARGAR TODO (ZIP)",
-                    data=fp,
-                    file_name="nano_banana_output.zip",
-                    mime="application/zip",
-                    type="primary",
-                    help="Descarga todas las imágenes generadas y el registro en un solo archivo."
-                )
+    render_zip_section()
 
 else:
     # Initial State or no content
@@ -286,3 +522,21 @@ else:
 # Results Display (Historical/Persisted if needed, or unnecessary if we show during gen)
 # Removed the old interactive column to keep it simple as requested: "input -> generate all -> done"
 
+# Live metrics panel (includes the calls made during this run)
+with st.sidebar:
+    with st.expander("📈 Métricas"):
+        metrics_rows = get_metrics().summary()
+        if metrics_rows:
+            st.dataframe(metrics_rows, hide_index=True, use_container_width=True)
+            st.download_button("Prometheus", data=get_metrics().to_prometheus(), file_name="metrics.prom", mime="text/plain")
+            st.download_button("JSON", data=get_metrics().to_json(), file_name="metrics.json", mime="application/json")
+        else:
+            st.caption("Aún no hay llamadas registradas.")
+        for model_id, model_stats in get_scheduler().stats(ClientRegistry.key_hash(api_key)).items():
+            st.caption(
+                f"⚖️ {model_id}: concurrencia {model_stats['limit']:.1f} · "
+                f"{model_stats['throttled']} limitadas · {model_stats['retries']} reintentos"
+            )
+
+# Time spent re-executing the script, shown from the next interaction on
+get_metrics()({"operation": "streamlit_rerun", "model": "", "seconds": time.perf_counter() - run_started, "outcome": "success"})
@@ -0,0 +1,341 @@
+"""
+Headless batch runner: processes a JSONL file of briefs without the Streamlit UI.
+
+Each line is a JSON object with the brief text in 'brief' (or 'body', optionally
+preceded by 'title') and an optional 'id' / 'request_id'. Prompts for the next
+brief are generated while the images of the current one render, and progress is
+checkpointed to a manifest so an interrupted run resumes where it stopped.
+
+With --batch-mode every image prompt is instead packed into a single Gemini
+batch job (cheaper, not interactive); the job id and item mapping are stored in
+<output>/batch_jobs.json, so a later run picks up a job that is still running.
+
+Usage:
+    python batch.py briefs.jsonl --output output --workers 4
+    python batch.py briefs.jsonl --batch-mode --poll-interval 60
+"""
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from logic import BatchJobStore, ContentGenerator, GenerationLog, ImageCache, PromptCache, RequestScheduler
+
+DEFAULT_TEXT_MODEL = "gemini-2.5-flash"
+DEFAULT_IMAGE_MODEL = "gemini-3.1-flash-image-preview"
+
+class BatchManifest:
+    """
+    Checkpoint manifest of a batch run, saved atomically after every change.
+
+    For each brief it stores the generated prompts, the images already written
+    (keyed by "<post_id>_<option_num>") and whether the brief is complete.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data: Dict[str, Any] = {"briefs": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def entry(self, brief_id: str) -> Dict[str, Any]:
+        with self._lock:
+            return self.data["briefs"].setdefault(brief_id, {"status": "pending", "prompts": None, "images": {}})
+
+    def update(self, brief_id: str, **fields):
+        with self._lock:
+            self.data["briefs"].setdefault(brief_id, {"status": "pending", "prompts": None, "images": {}}).update(fields)
+            self._save()
+
+    def add_image(self, brief_id: str, image_key: str, path: str):
+        with self._lock:
+            self.data["briefs"][brief_id]["images"][image_key] = path
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+def read_briefs(path: str) -> Iterator[Tuple[str, str]]:
+    # Streams (brief_id, brief_text) pairs from a JSONL file
+    with open(path, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            brief_id = str(record.get("id") or record.get("request_id") or f"line_{line_num}")
+            brief = record.get("brief")
+            if brief is None:
+                brief = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+            yield brief_id, brief
+
+def _safe_name(value: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", value).strip("_") or "brief"
+
+def _prompt_text(prompt_data: Any) -> str:
+    return prompt_data.get('prompt', str(prompt_data)) if isinstance(prompt_data, dict) else str(prompt_data)
+
+def pending_items(brief_id: str, brief: str, prompts: Dict[str, Any], entry: Dict[str, Any],
+                  output_dir: str) -> List[Dict[str, Any]]:
+    """
+    Image items of a brief that are not on disk yet, with the fields the
+    generation log needs.
+    """
+    items = []
+    for post in prompts.get('posts', []):
+        for i, prompt_data in enumerate(post.get('options', [])):
+            image_key = f"{post['id']}_{i+1}"
+            done_path = entry["images"].get(image_key)
+            if done_path and os.path.exists(done_path):
+                continue
+            items.append({
+                "brief_id": brief_id,
+                "image_key": image_key,
+                "brief_snippet": brief[:30],
+                "brief_hash": GenerationLog.brief_hash(brief),
+                "post_id": post['id'],
+                "concept": post.get('concept', ''),
+                "option_num": i+1,
+                "prompt": _prompt_text(prompt_data),
+                "output_path": os.path.join(output_dir, f"{_safe_name(brief_id)}_post_{post['id']}_opt_{i+1}.png"),
+            })
+    return items
+
+def _mark_done_if_complete(manifest: BatchManifest, brief_id: str, output_dir: str):
+    entry = manifest.entry(brief_id)
+    if entry["prompts"] is not None and not pending_items(brief_id, "", entry["prompts"], entry, output_dir):
+        manifest.update(brief_id, status="done")
+
+def run_batch(generator: ContentGenerator, briefs_path: str, guidelines: str, output_dir: str,
+              manifest: BatchManifest, generation_log: GenerationLog, max_workers: int = 4,
+              aspect_ratio: str = "1:1") -> Dict[str, Any]:
+    """
+    Runs the prompt -> image pipeline over every brief not yet completed in the manifest.
+    Returns throughput statistics for the run.
+    """
+    stats = {"briefs": 0, "images": 0, "failed_images": 0, "failed_briefs": 0,
+             "prompt_seconds": 0.0, "started": time.time()}
+    prompts_queue: "queue.Queue[Optional[Tuple[str, str, Any]]]" = queue.Queue(maxsize=1)
+
+    def produce_prompts():
+        # Runs one brief ahead of the image stage
+        try:
+            for brief_id, brief in read_briefs(briefs_path):
+                entry = manifest.entry(brief_id)
+                if entry["status"] == "done":
+                    continue
+                if entry["prompts"] is not None:
+                    prompts_queue.put((brief_id, brief, entry["prompts"]))
+                    continue
+                start = time.time()
+                try:
+                    result = generator.generate_prompts(brief, guidelines)
+                except Exception as e:
+                    prompts_queue.put((brief_id, brief, e))
+                    continue
+                stats["prompt_seconds"] += time.time() - start
+                manifest.update(brief_id, status="prompts_ready", prompts=result)
+                prompts_queue.put((brief_id, brief, result))
+        finally:
+            prompts_queue.put(None)
+
+    producer = threading.Thread(target=produce_prompts, name="prompt-producer", daemon=True)
+    producer.start()
+
+    while True:
+        item = prompts_queue.get()
+        if item is None:
+            break
+        brief_id, brief, result = item
+        stats["briefs"] += 1
+
+        if isinstance(result, Exception):
+            stats["failed_briefs"] += 1
+            print(f"❌ [{brief_id}] Error generando prompts: {result}")
+            continue
+
+        items = pending_items(brief_id, brief, result, manifest.entry(brief_id), output_dir)
+        jobs = [
+            {'key': n, 'prompt': image_item['prompt'], 'output_path': image_item['output_path'], 'aspect_ratio': aspect_ratio}
+            for n, image_item in enumerate(items)
+        ]
+
+        print(f"🎨 [{brief_id}] {len(jobs)} imagen(es) pendiente(s)")
+        failures = 0
+        recorded = set()
+
+        def record_image(n):
+            image_item = items[n]
+            manifest.add_image(brief_id, image_item['image_key'], image_item['output_path'])
+            generation_log.append({
+                "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "brief_snippet": image_item['brief_snippet'],
+                "brief_hash": image_item['brief_hash'],
+                "post_id": image_item['post_id'],
+                "concept": image_item['concept'],
+                "option_num": image_item['option_num'],
+                "prompt": image_item['prompt'],
+                "file_path": image_item['output_path']
+            })
+            recorded.add(n)
+
+        results = generator.generate_images(jobs, max_workers=max_workers)
+        try:
+            for n, success, msg in results:
+                if not success:
+                    failures += 1
+                    print(f"❌ [{brief_id}] Post {items[n]['post_id']} opción {items[n]['option_num']}: {msg}")
+                    continue
+                record_image(n)
+        except KeyboardInterrupt:
+            # Cancels queued calls and waits for the in-flight ones; every image that
+            # reached disk goes into the manifest so a resume doesn't pay for it again
+            results.close()
+            for n, image_item in enumerate(items):
+                if n not in recorded and os.path.exists(image_item['output_path']):
+                    record_image(n)
+            raise
+
+        stats["images"] += len(jobs) - failures
+        stats["failed_images"] += failures
+        if failures == 0:
+            manifest.update(brief_id, status="done")
+
+    stats["elapsed_seconds"] = time.time() - stats.pop("started")
+    return stats
+
+def run_batch_job(generator: ContentGenerator, briefs_path: str, guidelines: str, output_dir: str,
+                  manifest: BatchManifest, generation_log: GenerationLog, store: BatchJobStore,
+                  aspect_ratio: str = "1:1", poll_interval: float = 30.0) -> Dict[str, Any]:
+    """
+    Batch-mode variant of run_batch: all pending image prompts go into one Gemini
+    batch job, which is polled until done and then written to disk and the log.
+    Jobs left unfinished by an earlier run are completed first.
+    """
+    stats = {"briefs": 0, "images": 0, "failed_images": 0, "failed_briefs": 0,
+             "prompt_seconds": 0.0, "started": time.time()}
+
+    def finish_job(job_name: str):
+        print(f"⏳ Esperando el job {job_name}...")
+        job = generator.wait_for_batch(job_name, store, poll_interval=poll_interval)
+        saved, failed = generator.materialize_batch(job, store, generation_log)
+        for image_item in saved:
+            manifest.add_image(image_item['brief_id'], image_item['image_key'], image_item['output_path'])
+        for image_item, reason in failed:
+            print(f"❌ [{image_item['brief_id']}] Post {image_item['post_id']} opción {image_item['option_num']}: {reason}")
+        for brief_id in {image_item['brief_id'] for image_item in store.get(job_name)["items"]}:
+            _mark_done_if_complete(manifest, brief_id, output_dir)
+        stats["images"] += len(saved)
+        stats["failed_images"] += len(failed)
+
+    for job_name in generator.recover_batch_submissions(store):
+        print(f"🔁 Recuperado el job {job_name} de una ejecución interrumpida")
+    for job_name in store.pending():
+        finish_job(job_name)
+
+    items = []
+    for brief_id, brief in read_briefs(briefs_path):
+        entry = manifest.entry(brief_id)
+        if entry["status"] == "done":
+            continue
+        stats["briefs"] += 1
+        if entry["prompts"] is None:
+            start = time.time()
+            try:
+                prompts = generator.generate_prompts(brief, guidelines)
+            except Exception as e:
+                stats["failed_briefs"] += 1
+                print(f"❌ [{brief_id}] Error generando prompts: {e}")
+                continue
+            stats["prompt_seconds"] += time.time() - start
+            manifest.update(brief_id, status="prompts_ready", prompts=prompts)
+            entry = manifest.entry(brief_id)
+        items.extend(pending_items(brief_id, brief, entry["prompts"], entry, output_dir))
+
+    if items:
+        job_name = generator.submit_image_batch(items, store, aspect_ratio=aspect_ratio)
+        print(f"📤 Job {job_name} enviado con {len(items)} imagen(es)")
+        finish_job(job_name)
+
+    stats["elapsed_seconds"] = time.time() - stats.pop("started")
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Procesa un archivo JSONL de briefs sin la interfaz de Streamlit.")
+    parser.add_argument("briefs", help="Archivo JSONL con un brief por línea")
+    parser.add_argument("--output", default="output", help="Carpeta de salida")
+    parser.add_argument("--guidelines", default="brand_guidelines.txt", help="Archivo de guía de marca")
+    parser.add_argument("--text-model", default=DEFAULT_TEXT_MODEL)
+    parser.add_argument("--image-model", default=DEFAULT_IMAGE_MODEL)
+    parser.add_argument("--workers", type=int, default=4, help="Imágenes generadas en paralelo")
+    parser.add_argument("--aspect-ratio", default="1:1")
+    parser.add_argument("--manifest", default=None, help="Manifiesto de checkpoint (por defecto <output>/batch_manifest.json)")
+    parser.add_argument("--no-cache", action="store_true", help="Desactiva las cachés de prompts e imágenes")
+    parser.add_argument("--batch-mode", action="store_true",
+                        help="Envía todas las imágenes en un único job de Gemini Batch (más barato, sin latencia interactiva)")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="Segundos iniciales entre consultas del job")
+    parser.add_argument("--fake-client", action="store_true", help="Usa el cliente simulado local (sin API ni cuota)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    api_key = os.environ.get("GOOGLE_API_KEY", "")
+    if not api_key and not args.fake_client:
+        print("❌ Falta GOOGLE_API_KEY (variable de entorno o archivo .env)")
+        return 1
+
+    guidelines = ""
+    if os.path.exists(args.guidelines):
+        with open(args.guidelines, "r", encoding="utf-8") as f:
+            guidelines = f.read()
+
+    client = None
+    if args.fake_client:
+        from fake_client import FakeClient
+        client = FakeClient(batch_polls_to_complete=2)
+    generator = ContentGenerator(api_key, args.text_model, args.image_model, client=client)
+    # Retries 429/5xx and adapts in-flight requests below --workers to what the quota sustains
+    generator.scheduler = RequestScheduler(initial_concurrency=min(4, args.workers), max_concurrency=args.workers)
+    if not args.no_cache:
+        generator.image_cache = ImageCache(os.path.join(args.output, ".cache", "images"))
+        generator.prompt_cache = PromptCache(os.path.join(args.output, ".cache", "prompts"))
+
+    manifest = BatchManifest(args.manifest or os.path.join(args.output, "batch_manifest.json"))
+    generation_log = GenerationLog(args.output)
+    generation_log.migrate_csv()
+
+    try:
+        if args.batch_mode:
+            store = BatchJobStore(os.path.join(args.output, "batch_jobs.json"))
+            stats = run_batch_job(generator, args.briefs, guidelines, args.output, manifest, generation_log, store,
+                                  aspect_ratio=args.aspect_ratio, poll_interval=args.poll_interval)
+        else:
+            stats = run_batch(generator, args.briefs, guidelines, args.output, manifest, generation_log,
+                              max_workers=args.workers, aspect_ratio=args.aspect_ratio)
+    except KeyboardInterrupt:
+        print(f"\n⏸️ Interrumpido. Vuelve a ejecutar el mismo comando para continuar desde {manifest.path}")
+        return 130
+
+    elapsed = stats["elapsed_seconds"]
+    print("\n📊 Resumen")
+    print(f"   Briefs procesados: {stats['briefs']} ({stats['failed_briefs']} con error)")
+    print(f"   Imágenes generadas: {stats['images']} ({stats['failed_images']} con error)")
+    print(f"   Tiempo total: {elapsed:.1f}s (prompts: {stats['prompt_seconds']:.1f}s)")
+    if elapsed > 0:
+        print(f"   Rendimiento: {stats['images'] / elapsed * 60:.1f} imágenes/min, "
+              f"{stats['briefs'] / elapsed * 60:.2f} briefs/min")
+    return 0 if stats["failed_images"] == 0 and stats["failed_briefs"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
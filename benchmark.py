@@ -0,0 +1,480 @@
+"""
+Offline benchmarks for the content generator. No API calls are made: a
+FakeClient with configurable latency, jitter, error rate and payload size
+stands in for genai.Client.
+
+Usage:
+    python benchmark.py all --json report.json
+    python benchmark.py images --latency 0.5 --jitter 0.2 --concurrency 1 2 4 8
+    python benchmark.py all --json new.json --compare report.json
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+from PIL import Image, ImageDraw, ImageFont
+
+from fake_client import FakeClient
+from logic import BRAND_BACKGROUND, ContentGenerator, GenerationLog, ZipExporter, derive_aspect_ratio, save_image_bytes
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    # Nearest-rank percentiles, in milliseconds
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[index] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+def _timed(fn: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def make_generator(client: FakeClient) -> ContentGenerator:
+    return ContentGenerator("offline", "fake-text-model", "fake-image-model", client=client)
+
+def sample_png(size: int = 1024) -> bytes:
+    # Gradient plus noise: compresses roughly like a real illustration
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 48)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def _measure(save: Callable[[str], None], out_dir: str, iterations: int) -> Dict[str, Any]:
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    bytes_written = 0
+    for n in range(iterations):
+        path = os.path.join(out_dir, f"img_{n}.png")
+        save(path)
+        bytes_written += os.path.getsize(path)
+    return {
+        "cpu_ms_per_image": (time.process_time() - cpu_start) * 1000 / iterations,
+        "wall_ms_per_image": (time.perf_counter() - wall_start) * 1000 / iterations,
+        "bytes_per_image": bytes_written / iterations,
+    }
+
+def bench_save(iterations: int = 20, size: int = 1024) -> Dict[str, Any]:
+    """
+    Compares the previous save path (decode via PIL, re-encode PNG) with writing
+    the API bytes directly.
+    """
+    payload = sample_png(size)
+    out_dir = tempfile.mkdtemp(prefix="bench_save_")
+    try:
+        def pil_reencode(path: str):
+            with Image.open(io.BytesIO(payload)) as image:
+                image.save(path)
+
+        def raw_write(path: str):
+            save_image_bytes(payload, "image/png", path)
+
+        return {
+            "payload_bytes": len(payload),
+            "iterations": iterations,
+            "pil_reencode": _measure(pil_reencode, out_dir, iterations),
+            "raw_write": _measure(raw_write, out_dir, iterations),
+        }
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+def bench_prompts(client_kwargs: Dict[str, Any], iterations: int = 10) -> Dict[str, Any]:
+    """
+    Latency of generate_prompts, plus time-to-first-post and total time of the
+    streaming variant. Failed calls are counted, not timed.
+    """
+    generator = make_generator(FakeClient(**client_kwargs))
+    blocking, first_post, streamed = [], [], []
+    errors = 0
+    for n in range(iterations):
+        brief = f"Benchmark brief {n}"
+        # Each measurement fails on its own, so one error doesn't drop the other series
+        try:
+            blocking.append(_timed(lambda: generator.generate_prompts(brief, "")))
+        except Exception:
+            errors += 1
+
+        start = time.perf_counter()
+        first = None
+        try:
+            for _ in generator.generate_prompts_stream(brief, ""):
+                if first is None:
+                    first = time.perf_counter() - start
+        except Exception:
+            errors += 1
+            continue
+        streamed.append(time.perf_counter() - start)
+        first_post.append(first)
+    return {
+        "iterations": iterations,
+        "errors": errors,
+        "blocking": percentiles(blocking),
+        "stream_first_post": percentiles(first_post),
+        "stream_total": percentiles(streamed),
+    }
+
+def bench_images(client_kwargs: Dict[str, Any], concurrency_levels: List[int], num_images: int = 16) -> Dict[str, Any]:
+    """
+    Throughput and per-call latency of generate_images at each concurrency level.
+    """
+    results = {}
+    out_dir = tempfile.mkdtemp(prefix="bench_images_")
+    try:
+        for workers in concurrency_levels:
+            generator = make_generator(FakeClient(**client_kwargs))
+            call_times: List[float] = []
+            generate_image = generator.generate_image
+
+            def timed_generate_image(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return generate_image(*args, **kwargs)
+                finally:
+                    call_times.append(time.perf_counter() - start)
+
+            generator.generate_image = timed_generate_image
+            jobs = [
+                {'key': n, 'prompt': f"prompt {n}", 'output_path': os.path.join(out_dir, f"c{workers}_{n}.png")}
+                for n in range(num_images)
+            ]
+            start = time.perf_counter()
+            failures = sum(1 for _, success, _ in generator.generate_images(jobs, max_workers=workers) if not success)
+            elapsed = time.perf_counter() - start
+            results[str(workers)] = {
+                "images": num_images,
+                "failures": failures,
+                "wall_seconds": elapsed,
+                "images_per_second": num_images / elapsed if elapsed else 0.0,
+                "call_latency": percentiles(call_times),
+            }
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+def _legacy_csv_append(log_file: str, entry: Dict[str, Any]):
+    # Mirrors the old read -> concat -> rewrite of generation_log.csv
+    rows = []
+    if os.path.exists(log_file):
+        with open(log_file, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+    rows.append(entry)
+    with open(log_file, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(entry.keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def bench_log(sizes: List[int], appends: int = 50) -> Dict[str, Any]:
+    """
+    Cost of one more log write as the log grows, for the legacy CSV rewrite and
+    the append-only GenerationLog.
+    """
+    def entry(n: int) -> Dict[str, Any]:
+        return {
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "brief_snippet": "Benchmark brief",
+            "brief_hash": GenerationLog.brief_hash("Benchmark brief"),
+            "post_id": n % 5 + 1,
+            "concept": "Concept",
+            "option_num": n % 3 + 1,
+            "prompt": "A flat vector kiwi in a classroom. " * 8,
+            "file_path": f"output/post_{n}.png",
+        }
+
+    results = {}
+    for size in sizes:
+        work_dir = tempfile.mkdtemp(prefix="bench_log_")
+        try:
+            csv_file = os.path.join(work_dir, "legacy.csv")
+            generation_log = GenerationLog(work_dir)
+            with open(csv_file, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(entry(0).keys()))
+                writer.writeheader()
+                writer.writerows(entry(n) for n in range(size))
+            with open(generation_log.path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry(n)) + "\n" for n in range(size))
+
+            legacy = [_timed(lambda: _legacy_csv_append(csv_file, entry(size))) for _ in range(appends)]
+            jsonl = [_timed(lambda: generation_log.append(entry(size))) for _ in range(appends)]
+            query = [_timed(lambda: generation_log.query(post_id=1)) for _ in range(appends)]
+            results[str(size)] = {
+                "legacy_csv_append": percentiles(legacy),
+                "jsonl_append": percentiles(jsonl),
+                "indexed_query": percentiles(query),
+            }
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def bench_zip(folder_sizes: List[int], payload_bytes: int = 1024 * 1024, repeats: int = 3) -> Dict[str, Any]:
+    """
+    ZIP export time vs. number of images: legacy make_archive of the whole folder,
+    ZipExporter cold build, and ZipExporter cache hit.
+    """
+    payload = FakeClient(image_payload_bytes=payload_bytes).image_bytes
+    results = {}
+    for size in folder_sizes:
+        work_dir = tempfile.mkdtemp(prefix="bench_zip_")
+        try:
+            image_dir = os.path.join(work_dir, "output")
+            os.makedirs(image_dir)
+            paths = []
+            for n in range(size):
+                path = os.path.join(image_dir, f"img_{n}.png")
+                with open(path, "wb") as f:
+                    f.write(payload)
+                paths.append(path)
+
+            legacy = [_timed(lambda: shutil.make_archive(os.path.join(work_dir, "legacy"), "zip", image_dir))
+                      for _ in range(repeats)]
+            cold, warm = [], []
+            for _ in range(repeats):
+                exporter = ZipExporter()
+                cold.append(_timed(lambda: exporter.build(paths)))
+                warm.append(_timed(lambda: exporter.build(paths)))
+            results[str(size)] = {
+                "folder_bytes": size * len(payload),
+                "legacy_make_archive": percentiles(legacy),
+                "exporter_cold": percentiles(cold),
+                "exporter_cached": percentiles(warm),
+            }
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+DERIVE_FORMATS = ["9:16", "16:9", "4:5", "3:2"]
+
+def derive_fixture(decoration: bool = False, edge_text: bool = False) -> Image.Image:
+    # Cream master with a navy kiwi and a centred caption, like the generated posts
+    navy = (31, 45, 90)
+    image = Image.new("RGB", (1024, 1024), BRAND_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((362, 250, 662, 600), fill=navy)
+    draw.ellipse((560, 300, 600, 340), fill=BRAND_BACKGROUND)
+    draw.text((512, 760), "Hello / Hola", font=ImageFont.load_default(size=72), fill=navy, anchor="mm")
+    if decoration:
+        # Small ornament in a corner, no text near it
+        draw.ellipse((930, 40, 990, 100), fill=(240, 170, 170), outline=navy, width=4)
+    if edge_text:
+        # Footer text close to the left edge, which a tall crop has to cut
+        draw.text((40, 960), "mykiwi.es", font=ImageFont.load_default(size=40), fill=navy, anchor="lm")
+    return image
+
+# Expected crop-mode outcome per fixture; formats not listed must crop
+DERIVE_EXPECTED = {
+    "caption": {},
+    "decoration": {},
+    "edge_text": {"9:16": "needs_api"},
+}
+
+def bench_derive(iterations: int = 5) -> Dict[str, Any]:
+    """
+    Time of the local aspect-ratio derivation per format, plus a check that
+    cropping only gives up when rendered text would be cut: ornaments alone
+    must not send a format to the API.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bench_derive_")
+    try:
+        fixtures = {
+            "caption": derive_fixture(),
+            "decoration": derive_fixture(decoration=True),
+            "edge_text": derive_fixture(edge_text=True),
+        }
+        paths = {}
+        for name, image in fixtures.items():
+            paths[name] = os.path.join(work_dir, f"{name}.png")
+            image.save(paths[name])
+
+        out_path = os.path.join(work_dir, "derived.png")
+        timings = {
+            aspect_ratio: percentiles([
+                _timed(lambda: derive_aspect_ratio(paths["decoration"], out_path, aspect_ratio, "auto"))
+                for _ in range(iterations)
+            ])
+            for aspect_ratio in DERIVE_FORMATS
+        }
+        outcomes = {
+            name: {aspect_ratio: derive_aspect_ratio(path, out_path, aspect_ratio, "crop") for aspect_ratio in DERIVE_FORMATS}
+            for name, path in paths.items()
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    mismatches = [
+        f"{name} {aspect_ratio}: {outcome} (expected {DERIVE_EXPECTED[name].get(aspect_ratio, 'cropped')})"
+        for name, row in outcomes.items()
+        for aspect_ratio, outcome in row.items()
+        if outcome != DERIVE_EXPECTED[name].get(aspect_ratio, "cropped")
+    ]
+    return {"iterations": iterations, "formats": timings, "outcomes": outcomes, "mismatches": mismatches}
+
+def _flatten(prefix: str, value: Any, out: Dict[str, float]):
+    if isinstance(value, dict):
+        for key, child in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else key, child, out)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        out[prefix] = float(value)
+
+# Old implementations measured as yardsticks; they are not code under test
+REFERENCE_MEASUREMENTS = ("legacy_", "pil_reencode")
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.10) -> List[str]:
+    """
+    Lists percentile metrics that got slower than the baseline by more than `threshold`.
+    Reference measurements of the old implementations are left out.
+    """
+    old, new = {}, {}
+    _flatten("", baseline.get("results", {}), old)
+    _flatten("", current.get("results", {}), new)
+    regressions = []
+    for key, value in sorted(new.items()):
+        if not key.endswith(("p50_ms", "p95_ms", "p99_ms")) or key not in old or old[key] <= 0:
+            continue
+        if any(part.startswith(REFERENCE_MEASUREMENTS) for part in key.split(".")):
+            continue
+        change = (value - old[key]) / old[key]
+        if change > threshold:
+            regressions.append(f"{key}: {old[key]:.2f} -> {value:.2f} ms (+{change:.0%})")
+    return regressions
+
+def _print_percentile_table(title: str, rows: Dict[str, Dict[str, Any]]):
+    print(f"\n{title}")
+    print(f"  {'':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in rows.items():
+        if stats.get("count"):
+            print(f"  {name:<28}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+def print_report(results: Dict[str, Any]):
+    if "save" in results:
+        report = results["save"]
+        print(f"\nSave path ({report['payload_bytes'] / 1024:.0f} KB payload, {report['iterations']} iterations)")
+        print(f"  {'path':<14}{'CPU ms/img':>12}{'wall ms/img':>13}{'KB written/img':>16}")
+        for name in ("pil_reencode", "raw_write"):
+            row = report[name]
+            print(f"  {name:<14}{row['cpu_ms_per_image']:>12.2f}{row['wall_ms_per_image']:>13.2f}{row['bytes_per_image'] / 1024:>16.0f}")
+    if "prompts" in results:
+        report = results["prompts"]
+        _print_percentile_table(f"Prompt generation ({report['errors']} errors)", {
+            "blocking": report["blocking"],
+            "stream: first post": report["stream_first_post"],
+            "stream: total": report["stream_total"],
+        })
+    if "images" in results:
+        print("\nImage throughput")
+        print(f"  {'workers':<10}{'img/s':>8}{'wall s':>9}{'failures':>10}{'call p50 ms':>13}{'call p95 ms':>13}")
+        for workers, row in results["images"].items():
+            latency = row["call_latency"]
+            print(f"  {workers:<10}{row['images_per_second']:>8.2f}{row['wall_seconds']:>9.2f}{row['failures']:>10}"
+                  f"{latency.get('p50_ms', 0):>13.1f}{latency.get('p95_ms', 0):>13.1f}")
+    if "log" in results:
+        for size, row in results["log"].items():
+            _print_percentile_table(f"Log write with {size} existing rows", row)
+    if "zip" in results:
+        for size, row in results["zip"].items():
+            _print_percentile_table(f"ZIP export of {size} images ({row['folder_bytes'] / (1024 * 1024):.0f} MB)",
+                                    {k: v for k, v in row.items() if isinstance(v, dict)})
+    if "derive" in results:
+        report = results["derive"]
+        _print_percentile_table("Local aspect-ratio derivation (1024px master)", report["formats"])
+        print(f"  {'crop outcome':<28}" + "".join(f"{aspect_ratio:>11}" for aspect_ratio in DERIVE_FORMATS))
+        for name, row in report["outcomes"].items():
+            print(f"  {name:<28}" + "".join(f"{row[aspect_ratio]:>11}" for aspect_ratio in DERIVE_FORMATS))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks offline del generador de contenido.")
+    parser.add_argument("command", choices=["save", "prompts", "images", "log", "zip", "derive", "all"])
+    parser.add_argument("--latency", type=float, default=0.2, help="Latencia simulada por llamada (s)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Variación uniforme de la latencia (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de error 429/503 por llamada")
+    parser.add_argument("--payload-kb", type=int, default=1024, help="Tamaño de cada imagen simulada (KB)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--images", type=int, default=16, help="Imágenes por nivel de concurrencia")
+    parser.add_argument("--log-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--zip-sizes", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--json", default=None, help="Guarda el informe en este archivo JSON")
+    parser.add_argument("--compare", default=None, help="Informe JSON previo con el que comparar")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Empeoramiento tolerado al comparar (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    client_kwargs = {
+        "latency_seconds": args.latency,
+        "jitter_seconds": args.jitter,
+        "error_rate": args.error_rate,
+        "image_payload_bytes": args.payload_kb * 1024,
+        "seed": args.seed,
+    }
+    selected = ["save", "prompts", "images", "log", "zip", "derive"] if args.command == "all" else [args.command]
+
+    results: Dict[str, Any] = {}
+    if "save" in selected:
+        results["save"] = bench_save(args.iterations)
+    if "prompts" in selected:
+        results["prompts"] = bench_prompts(client_kwargs, args.iterations)
+    if "images" in selected:
+        results["images"] = bench_images(client_kwargs, args.concurrency, args.images)
+    if "log" in selected:
+        results["log"] = bench_log(args.log_sizes)
+    if "zip" in selected:
+        results["zip"] = bench_zip(args.zip_sizes, args.payload_kb * 1024)
+    if "derive" in selected:
+        results["derive"] = bench_derive(args.iterations)
+
+    report = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "client": client_kwargs,
+        },
+        "results": results,
+    }
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    mismatches = results.get("derive", {}).get("mismatches", [])
+    if mismatches:
+        print("\n❌ Derivación de formatos: resultados inesperados:")
+        for line in mismatches:
+            print(f"  {line}")
+        return 1
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.threshold)
+        if regressions:
+            print("\n⚠️ Regresiones respecto a la referencia:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\n✅ Sin regresiones respecto a la referencia.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
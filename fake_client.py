@@ -0,0 +1,247 @@
+"""
+Local stand-in for google.genai.Client, for tests and offline benchmarks.
+
+Implements the subset of the client that ContentGenerator uses
+(models.generate_content, models.generate_content_stream, models.list,
+caches.create/delete, batches.create/get/list) and records every call so tests can inspect what would
+have been sent. Latency, jitter, error rate and image payload size are
+configurable for benchmarks. Inject it with ContentGenerator(..., client=FakeClient()).
+"""
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+def _encode_png(width: int, height: int, raw: bytes, level: int = 6) -> bytes:
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, level)) + chunk(b"IEND", b"")
+
+def solid_png(width: int = 64, height: int = 64, rgb: Tuple[int, int, int] = (250, 246, 238)) -> bytes:
+    # Minimal valid RGB PNG, built without PIL
+    raw = b"".join(b"\x00" + bytes(rgb) * width for _ in range(height))
+    return _encode_png(width, height, raw)
+
+def noise_png(target_bytes: int) -> bytes:
+    # PNG of random pixels; barely compressible, so its size tracks target_bytes
+    side = max(1, int((target_bytes / 3) ** 0.5))
+    raw = b"".join(b"\x00" + os.urandom(side * 3) for _ in range(side))
+    return _encode_png(side, side, raw, level=1)
+
+class FakeAPIError(Exception):
+    """
+    Error raised by the fake client. Carries an HTTP-like `code` (429 or 503)
+    like the SDK's APIError.
+    """
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+def sample_posts(num_posts: int = 3) -> Dict[str, Any]:
+    return {"posts": [
+        {
+            "id": n,
+            "concept": f"Concept {n}",
+            "description": f"Description of post {n}",
+            "options": [
+                f"A flat vector kiwi in a classroom, option {k}. The text 'Hello / Hola' is large, clear, and readable."
+                for k in range(1, 4)
+            ]
+        }
+        for n in range(1, num_posts + 1)
+    ]}
+
+def _estimate_tokens(value: Any) -> int:
+    return max(1, len(str(value)) // 4)
+
+class _FakeModels:
+    def __init__(self, client: "FakeClient"):
+        self._client = client
+
+    def _usage(self, contents: Any, config: Any, output: str) -> SimpleNamespace:
+        prompt_tokens = _estimate_tokens(contents)
+        cached_tokens = 0
+        cached_name = getattr(config, "cached_content", None)
+        if cached_name:
+            cached_tokens = self._client.caches.token_count(cached_name)
+            prompt_tokens += cached_tokens
+        output_tokens = _estimate_tokens(output)
+        return SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            cached_content_token_count=cached_tokens,
+            candidates_token_count=output_tokens,
+            total_token_count=prompt_tokens + output_tokens
+        )
+
+    def generate_content(self, model: str, contents: Any, config: Any = None):
+        self._client.record("generate_content", model, contents, config)
+        self._client.caches.require(getattr(config, "cached_content", None))
+        self._client.simulate_call()
+        if "IMAGE" in (getattr(config, "response_modalities", None) or []):
+            data = self._client.image_bytes
+            part = SimpleNamespace(text=None, inline_data=SimpleNamespace(data=data, mime_type="image/png"))
+            return SimpleNamespace(text=None, parts=[part], usage_metadata=self._usage(contents, config, "x" * 1290 * 4))
+
+        text = json.dumps(sample_posts(self._client.num_posts))
+        part = SimpleNamespace(text=text, inline_data=None)
+        return SimpleNamespace(text=text, parts=[part], usage_metadata=self._usage(contents, config, text))
+
+    def generate_content_stream(self, model: str, contents: Any, config: Any = None) -> Iterator[SimpleNamespace]:
+        self._client.record("generate_content_stream", model, contents, config)
+        self._client.caches.require(getattr(config, "cached_content", None))
+        text = json.dumps(sample_posts(self._client.num_posts), indent=2)
+        size = self._client.stream_chunk_size
+        num_chunks = max(1, -(-len(text) // size))
+        # Time to first token, then the rest of the latency spread over the chunks
+        total = self._client.simulate_call(fraction=self._client.first_token_fraction)
+        chunk_delay = total * (1 - self._client.first_token_fraction) / num_chunks
+        for start in range(0, len(text), size):
+            if chunk_delay:
+                time.sleep(chunk_delay)
+            chunk = text[start:start + size]
+            yield SimpleNamespace(text=chunk, usage_metadata=None)
+
+    def list(self) -> List[SimpleNamespace]:
+        return [SimpleNamespace(name=f"models/{name}") for name in self._client.model_names]
+
+class _FakeCaches:
+    def __init__(self, client: "FakeClient"):
+        self._client = client
+        self._lock = threading.Lock()
+        self._entries: Dict[str, int] = {}
+        self._created = 0
+
+    def create(self, model: str, config: Any = None) -> SimpleNamespace:
+        self._client.record("caches.create", model, getattr(config, "contents", None), config)
+        tokens = _estimate_tokens(getattr(config, "system_instruction", "")) + _estimate_tokens(getattr(config, "contents", ""))
+        if tokens < self._client.min_cache_tokens:
+            raise ValueError(f"Cached content is too small: {tokens} < {self._client.min_cache_tokens} tokens")
+        with self._lock:
+            self._created += 1
+            name = f"cachedContents/fake-{self._created}"
+            self._entries[name] = tokens
+        return SimpleNamespace(name=name, model=model)
+
+    def delete(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def require(self, name: Optional[str]):
+        # Requests that reference a deleted or unknown handle fail like the real API
+        if name:
+            with self._lock:
+                known = name in self._entries
+            if not known:
+                raise FakeAPIError(404, f"CachedContent not found (or permission denied): {name}")
+
+    def token_count(self, name: str) -> int:
+        with self._lock:
+            return self._entries.get(name, 0)
+
+class _FakeBatches:
+    """
+    Batch backend: jobs stay pending, then running, and succeed after
+    `batch_polls_to_complete` calls to get(). Each item fails independently
+    with probability `error_rate`.
+    """
+    def __init__(self, client: "FakeClient"):
+        self._client = client
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, model: str, src: List[Dict[str, Any]], config: Any = None) -> SimpleNamespace:
+        self._client.record("batches.create", model, src, config)
+        with self._lock:
+            name = f"batches/fake-{len(self._jobs) + 1}"
+            display_name = config.get("display_name") if isinstance(config, dict) else getattr(config, "display_name", None)
+            self._jobs[name] = {"model": model, "requests": list(src), "polls": 0, "display_name": display_name}
+        return SimpleNamespace(name=name, display_name=display_name, state=SimpleNamespace(name="JOB_STATE_PENDING"), dest=None)
+
+    def list(self) -> List[SimpleNamespace]:
+        with self._lock:
+            return [SimpleNamespace(name=name, display_name=job["display_name"]) for name, job in self._jobs.items()]
+
+    def get(self, name: str) -> SimpleNamespace:
+        with self._lock:
+            job = self._jobs[name]
+            job["polls"] += 1
+            polls = job["polls"]
+        if polls < self._client.batch_polls_to_complete:
+            state = "JOB_STATE_PENDING" if polls == 1 else "JOB_STATE_RUNNING"
+            return SimpleNamespace(name=name, state=SimpleNamespace(name=state), dest=None)
+
+        responses = []
+        for _ in job["requests"]:
+            with self._client._random_lock:
+                fail = self._client._random.random() < self._client.error_rate
+            if fail:
+                responses.append(SimpleNamespace(response=None, error=SimpleNamespace(code=500, message="INTERNAL")))
+                continue
+            part = SimpleNamespace(text=None, inline_data=SimpleNamespace(data=self._client.image_bytes, mime_type="image/png"))
+            responses.append(SimpleNamespace(response=SimpleNamespace(parts=[part]), error=None))
+        return SimpleNamespace(
+            name=name,
+            state=SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+            dest=SimpleNamespace(inlined_responses=responses)
+        )
+
+class FakeClient:
+    """
+    Offline stand-in for genai.Client. Thread-safe; every call is appended to `calls`
+    as a (method, model, contents, config) tuple.
+
+    Each generate call sleeps `latency_seconds` +/- `jitter_seconds` (uniform) and
+    fails with a FakeAPIError (429 or 503, chosen at random) with probability `error_rate`.
+    `image_payload_bytes` controls the size of the returned PNG.
+    """
+    def __init__(self, num_posts: int = 3, image_bytes: Optional[bytes] = None, stream_chunk_size: int = 64,
+                 min_cache_tokens: int = 0, model_names: Optional[List[str]] = None,
+                 latency_seconds: float = 0.0, jitter_seconds: float = 0.0, error_rate: float = 0.0,
+                 image_payload_bytes: Optional[int] = None, first_token_fraction: float = 0.2,
+                 batch_polls_to_complete: int = 3, seed: Optional[int] = None):
+        self.num_posts = num_posts
+        if image_bytes is None:
+            image_bytes = noise_png(image_payload_bytes) if image_payload_bytes else solid_png()
+        self.image_bytes = image_bytes
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.error_rate = error_rate
+        self.first_token_fraction = first_token_fraction
+        self.batch_polls_to_complete = batch_polls_to_complete
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.stream_chunk_size = stream_chunk_size
+        self.min_cache_tokens = min_cache_tokens
+        self.model_names = model_names or ["gemini-2.5-flash", "gemini-3.1-flash-image-preview"]
+        self.calls: List[Tuple[str, str, Any, Any]] = []
+        self._calls_lock = threading.Lock()
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches(self)
+        self.batches = _FakeBatches(self)
+
+    def simulate_call(self, fraction: float = 1.0) -> float:
+        """
+        Sleeps for `fraction` of a sampled latency, then maybe raises a simulated
+        API error. Returns the full sampled latency.
+        """
+        with self._random_lock:
+            latency = max(0.0, self.latency_seconds + self._random.uniform(-self.jitter_seconds, self.jitter_seconds))
+            fail = self._random.random() < self.error_rate
+            code = self._random.choice((429, 503))
+        if latency:
+            time.sleep(latency * fraction)
+        if fail:
+            message = "RESOURCE_EXHAUSTED" if code == 429 else "UNAVAILABLE"
+            raise FakeAPIError(code, message)
+        return latency
+
+    def record(self, method: str, model: str, contents: Any, config: Any):
+        with self._calls_lock:
+            self.calls.append((method, model, contents, config))
@@ -1,20 +1,1328 @@
 from google import genai
 from google.genai import types
+import csv
+import hashlib
+import io
+import itertools
 import json
 import os
-from typing import List, Dict, Any
+import random
+import re
+import shutil
+import textwrap
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
 from PIL import Image
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_SYSTEM_INSTRUCTION = """
+You are an expert Social Media Content Strategist and Creative Director for 'My Kiwi Languages'.
+Your goal is to translate a client brief into executable image generation prompts.
+
+*** MASTER PROMPT / VISUAL IDENTITY ***
+1. THE PROTAGONIST: "Kiwi"
+   - Anthropomorphized, stylized Kiwi bird.
+   - Shape: Ovoid/pear/circular. Long, thin, slightly curved beak (wood/light orange).
+   - Personality: Eternal student, traveler. Adapts to environment (e.g., gaucho beret, Panama hat).
+   - Evolution:
+     * Flat Version: Dot eyes, flat colors, no black borders.
+     * Storybook Version: Defined ink borders, watercolor/crayon textures, expressive shiny eyes.
+
+2. ARTISTIC STYLES (DUALITY):
+   - Line A: "Modern/Flat" (Education/Business). Vector style, clean, geometric, negative space. Modern editorial design.
+   - Line B: "Hand-drawn" (Culture/Kids). Children's book illustration. Rough textures, soft brush shading, organic outlines.
+   - Geometry: Friendly curves, no aggressive angles. Rounded corners.
+
+3. COLOR PALETTE:
+   - Deep Navy (Trust/Authority). Main body color in flat versions.
+   - Cultural Accents: NZ (Black/White/Silver) mixed with Latin American flags (Ecuador: Yellow/Blue/Red; Argentina: Light Blue/White; Peru: Red/White etc).
+   - Backgrounds: Very soft pastels (cream, smoke grey, pale sky blue).
+
+4. NARRATIVE:
+   - Fusion of NZ and Latin America.
+   - Key Elements: Mate, thermoses, flags, entwined maps, sheep vs llamas, Southern Alps vs Andes.
+   - Scenery: Simplified classrooms, modern offices, minimal rural landscapes.
+
+*** CRITICAL INSTRUCTION: TEXT RENDERING (MANDATORY) ***
+- The Client Brief contains specific text for the image (e.g., "EN: ... / ES: ...").
+- **YOU MUST INCLUDE THIS TEXT IN THE GENERATED IMAGE PROMPT**.
+- Format the prompt like this: "A [Style Description] ... containing the text: '[Insert EN/ES Text Here]'. The text should be large, clear, and readable."
+- If the brief has "EN: Hello / ES: Hola", the prompt MUST explicitly say to include "Hello / Hola".
+
+Output:
+A JSON object containing a list of 'posts'.
+Each 'post' must have:
+- 'id': sequential number (1, 2, ...)
+- 'concept': Short title of the post idea.
+- 'description': Brief explanation of the post content.
+- 'options': A list of 3 distinct image prompts.
+   * Option 1: "Modern/Flat" Style (Business/Edu focus).
+   * Option 2: "Hand-drawn/Storybook" Style (Culture focus).
+   * Option 3: "Creative Fusion" (A mix or a specific variation requested in brief).
+   * EACH prompt must explicitly describe the Kiwi, the Setting, the Props, and THE TEXT to be rendered.
+   * **IMPORTANT**: This must be a simple List of STRINGS. Do not use objects/dictionaries for the prompts.
+   * **CRITICAL**: Each string MUST end with strict text rendering instructions if text is required by the brief.
+   * Example: "A watercolor kiwi reading a book. The text 'Classroom' is written on the cover."
+
+Return ONLY valid JSON.
+"""
+
+# Sent with the previous image when regenerating an option in edit mode
+EDIT_INSTRUCTION = """
+Edit the attached image. Keep its composition, art style, characters and any rendered text exactly as they are,
+except for these corrections:
+{correction}
+Text must stay large, clear, and readable.
+"""
+
+def compact_prompt_text(text: str) -> str:
+    # Drops indentation and trailing spaces and collapses runs of blank lines
+    lines = [line.rstrip() for line in textwrap.dedent(text).splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+class ContextCache:
+    """
+    Registry of server-side cached-content handles for the static prompt prefix
+    (system instruction + brand guidelines).
+
+    Handles are keyed by a hash of (API key, text model, system instruction,
+    guidelines): a handle belongs to the project of the key that created it, and
+    editing the prefix creates a new one. Handles are recreated shortly before
+    their TTL expires. Cached content is billed for as long as it is stored, so
+    a handle is deleted server-side when it is refreshed, invalidated, or pushed
+    out by newer prefixes beyond `max_handles`. Prefixes the API refuses to
+    cache (e.g. too few tokens) are remembered and sent inline instead.
+    """
+    def __init__(self, ttl_seconds: int = 3600, refresh_margin_seconds: int = 60, max_handles: int = 4):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.max_handles = max_handles
+        self._lock = threading.Lock()
+        # key -> (name, expires_at, client that created it); least recently used first
+        self._handles: "OrderedDict[str, Tuple[str, float, Any]]" = OrderedDict()
+        self._uncacheable: Dict[str, float] = {}
+
+    @staticmethod
+    def make_key(model_id: str, system_instruction: str, guidelines: str, key_hash: str = "") -> str:
+        payload = json.dumps([key_hash, model_id, system_instruction, guidelines], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_or_create(self, client, model_id: str, system_instruction: str, guidelines: str,
+                      key_hash: str = "") -> Optional[str]:
+        """
+        Returns the name of a live cached-content handle for this prefix, or None
+        if the prefix should be sent inline. `key_hash` identifies the API key
+        `client` uses (see ClientRegistry.key_hash).
+        """
+        key = self.make_key(model_id, system_instruction, guidelines, key_hash)
+        now = time.time()
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and handle[1] - self.refresh_margin_seconds > now:
+                self._handles.move_to_end(key)
+                return handle[0]
+            if now - self._uncacheable.get(key, 0) < self.ttl_seconds:
+                return None
+
+        try:
+            cached = client.caches.create(
+                model=model_id,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"kiwi-prefix-{key[:12]}",
+                    system_instruction=system_instruction,
+                    contents=[f"BRAND GUIDELINES:\n{guidelines}"],
+                    ttl=f"{self.ttl_seconds}s"
+                )
+            )
+        except Exception as e:
+            print(f"⚠️ Context caching unavailable, sending prefix inline: {e}")
+            with self._lock:
+                self._uncacheable[key] = now
+            return None
+
+        with self._lock:
+            replaced = []
+            if key in self._handles:
+                replaced.append(self._handles.pop(key))
+            self._handles[key] = (cached.name, now + self.ttl_seconds, client)
+            while len(self._handles) > self.max_handles:
+                replaced.append(self._handles.popitem(last=False)[1])
+        for old_name, _, old_client in replaced:
+            self._delete(old_client, old_name)
+        return cached.name
+
+    def invalidate(self, name: str, client=None):
+        # Forgets the handle and deletes it server-side (with `client` if it is not known here)
+        with self._lock:
+            removed = [(key, handle) for key, handle in self._handles.items() if handle[0] == name]
+            for key, _ in removed:
+                del self._handles[key]
+        owner = removed[0][1][2] if removed else client
+        if owner is not None:
+            self._delete(owner, name)
+
+    @staticmethod
+    def _delete(client, name: str):
+        try:
+            client.caches.delete(name=name)
+        except Exception as e:
+            # Already expired or gone; it stops being billed either way
+            print(f"⚠️ Could not delete cached content {name}: {e}")
+
+class ImageCache:
+    """
+    Content-addressed on-disk cache of generated images.
+
+    Entries are keyed by a hash of (image model, normalized prompt, aspect ratio,
+    image size). Hits are copied to the requested output path without calling the
+    API. Entries older than `max_age_seconds` are dropped, and the least recently
+    used ones are evicted once the cache grows beyond `max_bytes`.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 500 * 1024 * 1024, max_age_seconds: float = 30 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_id: str, prompt: str, aspect_ratio: str, image_size: str) -> str:
+        # Whitespace differences should not produce different renders
+        normalized_prompt = " ".join(prompt.split())
+        payload = json.dumps([model_id, normalized_prompt, aspect_ratio, image_size], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.png")
+
+    def get(self, key: str, output_path: str) -> bool:
+        """
+        Copies the cached image for `key` to `output_path`. Returns True on a hit.
+        """
+        entry_path = self._entry_path(key)
+        with self._lock:
+            try:
+                age = time.time() - os.path.getmtime(entry_path)
+            except OSError:
+                self.misses += 1
+                return False
+
+            if age > self.max_age_seconds:
+                self._remove(entry_path)
+                self.misses += 1
+                return False
+
+            output_dir = os.path.dirname(output_path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            shutil.copyfile(entry_path, output_path)
+            # Touch the entry so eviction treats it as recently used
+            os.utime(entry_path, None)
+            self.hits += 1
+            return True
+
+    def put(self, key: str, image_path: str):
+        """
+        Stores a copy of `image_path` under `key` and enforces the eviction policy.
+        """
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            shutil.copyfile(image_path, tmp_path)
+            os.replace(tmp_path, entry_path)
+            self._evict()
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".png"):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.max_age_seconds:
+                self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+
+        # Oldest access first
+        entries.sort()
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        entries = 0
+        total_bytes = 0
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".png"):
+                    entries += 1
+                    total_bytes += entry.stat().st_size
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total_bytes}
+
+class PromptCache:
+    """
+    Persistent memo cache for generate_prompts results.
+
+    Each entry is a JSON file named after a hash of (text model, system
+    instruction, guidelines, brief) and expires after `ttl_seconds`.
+    """
+    def __init__(self, cache_dir: str, ttl_seconds: float = 7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text_model_id: str, system_instruction: str, guidelines: str, brief: str) -> str:
+        payload = json.dumps([text_model_id, system_instruction, guidelines.strip(), brief.strip()], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._entry_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry["result"]
+
+    def put(self, key: str, result: Dict[str, Any]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "result": result}, f, ensure_ascii=False)
+        os.replace(tmp_path, entry_path)
+
+LOG_FIELDS = ["date", "brief_snippet", "brief_hash", "post_id", "concept", "option_num", "prompt", "file_path"]
+
+@contextmanager
+def _file_lock(lock_path: str):
+    # Cross-process exclusive lock held on a sidecar file
+    with open(lock_path, "a+") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+class GenerationLog:
+    """
+    Append-only generation log stored as JSON Lines.
+
+    Each append writes a single line under a file lock, so concurrent sessions
+    can share the same log. Queries by brief, post and date are served from
+    in-memory indexes that are refreshed incrementally from the last read offset.
+    """
+    def __init__(self, log_dir: str, filename: str = "generation_log.jsonl"):
+        self.log_dir = log_dir
+        self.path = os.path.join(log_dir, filename)
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._records: List[Dict[str, Any]] = []
+        self._by_brief: Dict[str, List[int]] = {}
+        self._by_post: Dict[str, List[int]] = {}
+        self._by_date: Dict[str, List[int]] = {}
+
+    @staticmethod
+    def brief_hash(brief: str) -> str:
+        return hashlib.sha256(brief.strip().encode("utf-8")).hexdigest()[:16]
+
+    def append(self, entry: Dict[str, Any]):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        os.makedirs(self.log_dir, exist_ok=True)
+        with self._lock, _file_lock(self.path + ".lock"):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def _index(self, record: Dict[str, Any]):
+        idx = len(self._records)
+        self._records.append(record)
+        if record.get("brief_hash"):
+            self._by_brief.setdefault(record["brief_hash"], []).append(idx)
+        self._by_post.setdefault(str(record.get("post_id")), []).append(idx)
+        self._by_date.setdefault(str(record.get("date", ""))[:10], []).append(idx)
+
+    def _refresh(self):
+        # Index only the lines appended since the last refresh
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # Ignore a trailing partial line that is still being written
+        end = data.rfind(b"\n") + 1
+        for raw_line in data[:end].splitlines():
+            if raw_line.strip():
+                try:
+                    self._index(json.loads(raw_line))
+                except ValueError:
+                    continue
+        self._offset += end
+
+    def query(self, brief: Optional[str] = None, post_id: Any = None, date: Optional[str] = None,
+              since: Optional[str] = None, until: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Returns log records matching every given filter.
+        `date` matches a single day (YYYY-MM-DD); `since`/`until` bound the timestamp.
+        """
+        with self._lock:
+            self._refresh()
+            candidates = None
+            if brief is not None:
+                candidates = set(self._by_brief.get(self.brief_hash(brief), []))
+            if post_id is not None:
+                post_ids = set(self._by_post.get(str(post_id), []))
+                candidates = post_ids if candidates is None else candidates & post_ids
+            if date is not None:
+                date_ids = set(self._by_date.get(date, []))
+                candidates = date_ids if candidates is None else candidates & date_ids
+            if candidates is None:
+                candidates = range(len(self._records))
+
+            results = []
+            for idx in sorted(candidates):
+                record = self._records[idx]
+                record_date = str(record.get("date", ""))
+                if since is not None and record_date < since:
+                    continue
+                if until is not None and record_date > until:
+                    continue
+                results.append(record)
+            return results
+
+    def to_csv_bytes(self, records: Optional[List[Dict[str, Any]]] = None) -> bytes:
+        if records is None:
+            records = self.query()
+        fieldnames = list(LOG_FIELDS)
+        for record in records:
+            for field in record:
+                if field not in fieldnames:
+                    fieldnames.append(field)
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(records)
+        return buffer.getvalue().encode("utf-8")
+
+    def export_csv(self, csv_path: str, records: Optional[List[Dict[str, Any]]] = None):
+        with open(csv_path, "wb") as f:
+            f.write(self.to_csv_bytes(records))
+
+    def migrate_csv(self, csv_path: Optional[str] = None) -> int:
+        """
+        Imports a legacy generation_log.csv into the log and renames it to
+        *.migrated so it is only imported once. Returns the number of rows imported.
+        """
+        csv_path = csv_path or os.path.join(self.log_dir, "generation_log.csv")
+        if not os.path.exists(csv_path):
+            return 0
+
+        with open(csv_path, "r", encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+        lines = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+        os.makedirs(self.log_dir, exist_ok=True)
+        with self._lock, _file_lock(self.path + ".lock"):
+            # Another process may have migrated it while we waited for the lock
+            if not os.path.exists(csv_path):
+                return 0
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            os.replace(csv_path, csv_path + ".migrated")
+        return len(rows)
+
+class IncrementalPostParser:
+    """
+    Incremental JSON scanner that returns each post object as soon as it is closed.
+
+    Posts are the objects that sit directly inside the top-level array, or inside
+    the "posts" array of the top-level object ({"posts": [{...}, {...}]}); objects
+    in any other array are skipped.
+    Text that can no longer contain an open post is dropped from the buffer.
+    """
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._post_start: Optional[int] = None
+        # Last string seen directly in the top-level object, and the key of the array being read
+        self._member_key = ""
+        self._array_key: Optional[str] = None
+
+    def _in_posts_array(self) -> bool:
+        return self._stack == ['['] or (self._stack == ['{', '['] and self._array_key == "posts")
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self._text += chunk
+        text = self._text
+        posts = []
+
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                elif self._stack == ['{']:
+                    self._member_key += ch
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._stack == ['{']:
+                    self._member_key = ""
+            elif ch in '{[':
+                if ch == '[' and self._stack == ['{']:
+                    self._array_key = self._member_key
+                if ch == '{' and self._in_posts_array():
+                    self._post_start = i
+                self._stack.append(ch)
+            elif ch in '}]':
+                if self._stack:
+                    self._stack.pop()
+                if ch == '}' and self._post_start is not None and self._in_posts_array():
+                    try:
+                        posts.append(json.loads(text[self._post_start:i + 1]))
+                    except ValueError:
+                        pass
+                    self._post_start = None
+
+        # Keep only the part of the buffer that may still belong to an open post
+        keep_from = self._post_start if self._post_start is not None else len(text)
+        self._text = text[keep_from:]
+        self._pos = len(text) - keep_from
+        if self._post_start is not None:
+            self._post_start = 0
+        return posts
+
+# Formats that are already compressed; deflating them again only costs CPU
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".zip"}
+
+class ZipExporter:
+    """
+    Builds ZIP archives in memory from a list of files plus optional in-memory extras.
+
+    Already-compressed images are STORED instead of deflated, and finished archives
+    are kept in a small LRU keyed by a manifest hash (paths, sizes, mtimes and
+    extra contents), so an unchanged set of files is never archived twice.
+    """
+    def __init__(self, max_cached: int = 4):
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def manifest_hash(paths: List[str], extra_files: Optional[Dict[str, bytes]] = None) -> str:
+        digest = hashlib.sha256()
+        for path in sorted(paths):
+            stat = os.stat(path)
+            digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+        for name, data in sorted((extra_files or {}).items()):
+            digest.update(f"{name}\0{hashlib.sha256(data).hexdigest()}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def has(self, key: str) -> bool:
+        with self._lock:
+            return key in self._cache
+
+    def build(self, paths: List[str], extra_files: Optional[Dict[str, bytes]] = None) -> bytes:
+        key = self.manifest_hash(paths, extra_files)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for path in paths:
+                extension = os.path.splitext(path)[1].lower()
+                compress_type = zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+                archive.write(path, arcname=os.path.basename(path), compress_type=compress_type)
+            for name, data in (extra_files or {}).items():
+                archive.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+        data = buffer.getvalue()
+
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return data
+
+MIME_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+}
+
+def extension_for_mime(mime_type: Optional[str]) -> str:
+    return MIME_EXTENSIONS.get((mime_type or "").lower(), ".png")
+
+def save_image_bytes(data: bytes, mime_type: Optional[str], output_path: str) -> bool:
+    """
+    Writes image bytes as returned by the API to `output_path`.
+
+    When the payload is already in the format implied by the file extension the
+    bytes are written as-is (no decode/re-encode). Otherwise the image is
+    converted through PIL. Returns True when the fast path was used.
+    """
+    wanted = os.path.splitext(output_path)[1].lower()
+    if wanted == ".jpeg":
+        wanted = ".jpg"
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if extension_for_mime(mime_type) == wanted:
+        tmp_path = f"{output_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, output_path)
+        return True
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.save(output_path)
+    return False
+
+def optimize_image(image_path: str) -> int:
+    """
+    Losslessly recompresses a PNG in place if that makes it smaller.
+    Uses oxipng when installed, otherwise PIL's optimizer. Returns bytes saved.
+    """
+    if os.path.splitext(image_path)[1].lower() != ".png":
+        return 0
+    before = os.path.getsize(image_path)
+    tmp_path = f"{image_path}.{threading.get_ident()}.opt.tmp"
+    try:
+        import oxipng
+        oxipng.optimize(image_path, tmp_path)
+    except ImportError:
+        with Image.open(image_path) as image:
+            image.save(tmp_path, format="PNG", optimize=True)
+
+    after = os.path.getsize(tmp_path)
+    if after < before:
+        os.replace(tmp_path, image_path)
+        return before - after
+    os.remove(tmp_path)
+    return 0
+
+def make_thumbnail(image_path: str, thumb_path: str, max_size: int = 384, fmt: str = "WEBP", quality: int = 80) -> str:
+    """
+    Writes a small preview of `image_path` to `thumb_path`.
+    """
+    with Image.open(image_path) as image:
+        image.thumbnail((max_size, max_size))
+        if fmt.upper() == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        tmp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format=fmt, quality=quality)
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+# Cream background from the brand palette, used to pad derived formats
+BRAND_BACKGROUND = (250, 246, 238)
+# Luma step (0-255) between neighbouring pixels treated as a hard edge
+TEXT_EDGE_THRESHOLD = 48
+# Share of hard-edge pixels above which a grid cell looks like lettering; the
+# outline of a shape crossing a cell stays well below it
+TEXT_CELL_DENSITY = 0.15
+# Lettering is a horizontal run of at least this many dense cells
+TEXT_MIN_RUN_CELLS = 3
+
+def parse_aspect_ratio(aspect_ratio: str) -> float:
+    width, height = aspect_ratio.split(":")
+    return float(width) / float(height)
+
+def derived_image_path(master_path: str, aspect_ratio: str) -> str:
+    # post_1_opt_1_....png -> post_1_opt_1_..._9x16.png
+    stem, extension = os.path.splitext(master_path)
+    return f"{stem}_{aspect_ratio.replace(':', 'x')}{extension or '.png'}"
+
+def saliency_map(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (saliency, edges) for an RGB uint8 array.
+
+    Saliency is local contrast (luma gradient) plus colour distance from the
+    median border colour, which is usually the flat background. `edges` marks
+    hard luma steps.
+    """
+    rgb = pixels.astype(np.float32)
+    luma = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    gradient = np.zeros_like(luma)
+    gradient[:, 1:] += np.abs(np.diff(luma, axis=1))
+    gradient[1:, :] += np.abs(np.diff(luma, axis=0))
+
+    border = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+    distance = np.sqrt(((rgb - np.median(border, axis=0)) ** 2).sum(axis=2))
+    saliency = gradient / (gradient.max() + 1e-6) + distance / (distance.max() + 1e-6)
+    return saliency, gradient > TEXT_EDGE_THRESHOLD
+
+def text_regions(edges: np.ndarray, cell: int, density: float = TEXT_CELL_DENSITY) -> np.ndarray:
+    """
+    Pixel mask of likely rendered text: grid cells dense with hard edges that
+    belong to a horizontal run of TEXT_MIN_RUN_CELLS or more (lettering runs
+    along a line). Outlines and small isolated shapes are not included.
+    """
+    height, width = edges.shape
+    rows, cols = -(-height // cell), -(-width // cell)
+    grid = np.zeros((rows * cell, cols * cell), dtype=np.float32)
+    grid[:height, :width] = edges
+    edge_share = grid.reshape(rows, cell, cols, cell).mean(axis=(1, 3))
+    dense = edge_share >= density
+
+    # Start of every run of TEXT_MIN_RUN_CELLS dense cells, then spread to the run's cells
+    run = TEXT_MIN_RUN_CELLS
+    starts = np.zeros_like(dense)
+    if cols >= run:
+        starts[:, :cols - run + 1] = np.logical_and.reduce([dense[:, k:cols - run + 1 + k] for k in range(run)])
+    cells = np.zeros_like(dense)
+    for k in range(run):
+        cells[:, k:] |= starts[:, :cols - k]
+
+    # Grow into neighbouring cells with some edges: word gaps, ascenders, descenders
+    # then add a one-cell margin so a crop never ends flush against the lettering
+    weak = edge_share >= density / 3
+    for step in range(3):
+        grown = cells.copy()
+        grown[1:] |= cells[:-1]
+        grown[:-1] |= cells[1:]
+        grown[:, 1:] |= cells[:, :-1]
+        grown[:, :-1] |= cells[:, 1:]
+        cells = grown if step == 2 else cells | (grown & weak)
+    return np.repeat(np.repeat(cells, cell, axis=0), cell, axis=1)[:height, :width]
+
+def _window_sums(profile: np.ndarray, length: int) -> np.ndarray:
+    totals = np.concatenate(([0.0], np.cumsum(profile, dtype=np.float64)))
+    return totals[length:] - totals[:-length]
+
+def best_window(profile: np.ndarray, length: int, keep: Optional[np.ndarray] = None) -> int:
+    # Offset of the `length`-wide window holding the most of `profile`, among the
+    # windows holding the most of `keep` if given; near-equal windows are broken
+    # by centring on the profile's centre of mass
+    sums = _window_sums(profile, length)
+    allowed = np.ones(len(sums), dtype=bool)
+    if keep is not None:
+        kept = _window_sums(keep, length)
+        allowed = kept >= kept.max()
+    candidates = np.flatnonzero(allowed & (sums >= sums[allowed].max() * 0.999))
+    mass = profile.sum()
+    centroid = (profile * np.arange(len(profile))).sum() / mass if mass > 0 else (len(profile) - 1) / 2
+    return int(candidates[np.argmin(np.abs(candidates + (length - 1) / 2 - centroid))])
+
+def derive_aspect_ratio(master_path: str, output_path: str, aspect_ratio: str, mode: str = "auto",
+                        background: Tuple[int, int, int] = BRAND_BACKGROUND, max_lost_text: float = 0.0) -> str:
+    """
+    Writes a copy of `master_path` in another aspect ratio without calling the API.
+
+    mode "crop" cuts the most salient window that keeps as much text as possible,
+    and gives up ("needs_api", nothing written) when more than `max_lost_text` of
+    the text regions would still fall outside it; "pad" centres the image on
+    `background`; "auto" crops and pads instead when the crop would cut text.
+    Returns "cropped", "padded" or "needs_api".
+    """
+    with Image.open(master_path) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    height, width = pixels.shape[:2]
+    target = parse_aspect_ratio(aspect_ratio)
+
+    result = None
+    if mode in ("crop", "auto"):
+        saliency, edges = saliency_map(pixels)
+        text = text_regions(edges, cell=max(8, min(height, width) // 64))
+        if target < width / height:
+            # Narrower: keep full height, slide horizontally
+            crop_width = max(1, round(height * target))
+            x = best_window(saliency.sum(axis=0), crop_width, keep=text.sum(axis=0))
+            window = (slice(None), slice(x, x + crop_width))
+        else:
+            crop_height = max(1, round(width / target))
+            y = best_window(saliency.sum(axis=1), crop_height, keep=text.sum(axis=1))
+            window = (slice(y, y + crop_height), slice(None))
+
+        total_text = int(text.sum())
+        lost_text = total_text - int(text[window].sum())
+        if total_text == 0 or lost_text / total_text <= max_lost_text:
+            result, status = pixels[window], "cropped"
+        elif mode == "crop":
+            return "needs_api"
+
+    if result is None:
+        if target > width / height:
+            canvas_width, canvas_height = round(height * target), height
+        else:
+            canvas_width, canvas_height = width, round(width / target)
+        result = np.empty((canvas_height, canvas_width, 3), dtype=np.uint8)
+        result[:] = background
+        x, y = (canvas_width - width) // 2, (canvas_height - height) // 2
+        result[y:y + height, x:x + width] = pixels
+        status = "padded"
+
+    tmp_path = f"{output_path}.{threading.get_ident()}.tmp"
+    Image.fromarray(np.ascontiguousarray(result)).save(tmp_path, format="PNG")
+    os.replace(tmp_path, output_path)
+    return status
+
+class ImagePostProcessor:
+    """
+    Runs CPU-bound image work (thumbnails, optional lossless PNG optimization,
+    derived aspect ratios) in a thread pool, off the request path.
+
+    Thumbnails live in a '.thumbs' folder next to the full-resolution image.
+    The pool is created lazily on first use. Threads rather than processes:
+    Pillow's encode/resize and NumPy release the GIL, and worker processes
+    would re-import the Streamlit script (or fork a multithreaded server).
+    """
+    def __init__(self, max_workers: int = 2, thumb_size: int = 384, thumb_format: str = "WEBP"):
+        self.max_workers = max_workers
+        self.thumb_size = thumb_size
+        self.thumb_format = thumb_format
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def thumbnail_path(self, image_path: str) -> str:
+        extension = ".jpg" if self.thumb_format.upper() == "JPEG" else f".{self.thumb_format.lower()}"
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        return os.path.join(os.path.dirname(image_path), ".thumbs", name + extension)
+
+    def submit_thumbnail(self, image_path: str) -> Future:
+        return self._get_executor().submit(
+            make_thumbnail, image_path, self.thumbnail_path(image_path), self.thumb_size, self.thumb_format
+        )
+
+    def submit_optimize(self, image_path: str) -> Future:
+        return self._get_executor().submit(optimize_image, image_path)
+
+    def submit_derive(self, master_path: str, output_path: str, aspect_ratio: str, mode: str = "auto",
+                      max_lost_text: float = 0.0) -> Future:
+        return self._get_executor().submit(derive_aspect_ratio, master_path, output_path, aspect_ratio, mode,
+                                           BRAND_BACKGROUND, max_lost_text)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+class BytesLRU:
+    """
+    In-memory LRU of file contents keyed by (path, mtime, size), bounded by total bytes.
+    Avoids re-reading the same images from disk on every rerun.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, int, int], bytes]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def read(self, path: str) -> bytes:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = data
+                self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+        return data
+
+class ClientRegistry:
+    """
+    Process-wide pool of GenAI clients, one per API key (indexed by its hash).
+
+    Reusing a client reuses its HTTP connection pool, so Streamlit reruns keep
+    their keep-alive connections instead of paying a new TLS handshake. The
+    model catalog is cached per key for `catalog_ttl_seconds`.
+    """
+    def __init__(self, catalog_ttl_seconds: float = 3600):
+        self.catalog_ttl_seconds = catalog_ttl_seconds
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Any] = {}
+        self._catalogs: Dict[str, Tuple[float, List[str]]] = {}
+
+    @staticmethod
+    def key_hash(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    def get_client(self, api_key: str):
+        key = self.key_hash(api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = genai.Client(api_key=api_key)
+                self._clients[key] = client
+                print("✅ Google GenAI Client initialized (shared)")
+            return client
+
+    def list_models(self, api_key: str) -> List[str]:
+        key = self.key_hash(api_key)
+        with self._lock:
+            cached = self._catalogs.get(key)
+            if cached is not None and time.time() - cached[0] < self.catalog_ttl_seconds:
+                return cached[1]
+
+        # Listing paginates through every model, so do it outside the lock
+        models = [m.name for m in self.get_client(api_key).models.list()]
+        with self._lock:
+            self._catalogs[key] = (time.time(), models)
+        return models
+
+def usage_fields(usage_metadata: Any) -> Dict[str, int]:
+    # Token counts from a response's usage_metadata (missing counts become 0)
+    return {
+        "prompt_tokens": getattr(usage_metadata, "prompt_token_count", None) or 0,
+        "cached_tokens": getattr(usage_metadata, "cached_content_token_count", None) or 0,
+        "output_tokens": getattr(usage_metadata, "candidates_token_count", None) or 0,
+        "total_tokens": getattr(usage_metadata, "total_token_count", None) or 0,
+    }
+
+class MetricsRecorder:
+    """
+    Hook for ContentGenerator.hooks that aggregates call records per (operation, model).
+
+    Keeps cumulative counters and fixed-bucket latency histograms (exported in
+    Prometheus text format) plus a rolling window of recent latencies used for
+    the percentiles in summary() and to_json().
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    TOKEN_FIELDS = ("prompt_tokens", "cached_tokens", "output_tokens", "total_tokens")
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def __call__(self, record: Dict[str, Any]):
+        key = (record["operation"], record.get("model") or "")
+        seconds = record.get("seconds", 0.0)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {
+                    "outcomes": {},
+                    "bucket_counts": [0] * len(self.BUCKETS),
+                    "count": 0,
+                    "sum_seconds": 0.0,
+                    "bytes_received": 0,
+                    "tokens": {field: 0 for field in self.TOKEN_FIELDS},
+                    "recent": deque(maxlen=self.window),
+                }
+                self._series[key] = series
+
+            outcome = record.get("outcome", "success")
+            series["outcomes"][outcome] = series["outcomes"].get(outcome, 0) + 1
+            series["count"] += 1
+            series["sum_seconds"] += seconds
+            series["bytes_received"] += record.get("bytes_received", 0)
+            for field in self.TOKEN_FIELDS:
+                series["tokens"][field] += record.get(field, 0)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series["bucket_counts"][i] += 1
+            series["recent"].append(seconds)
+
+    @staticmethod
+    def _percentile(ordered: List[float], p: float) -> float:
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def summary(self) -> List[Dict[str, Any]]:
+        rows = []
+        with self._lock:
+            for (operation, model), series in sorted(self._series.items()):
+                recent = sorted(series["recent"])
+                rows.append({
+                    "operation": operation,
+                    "model": model,
+                    "calls": series["count"],
+                    "errors": series["outcomes"].get("error", 0),
+                    "cache_hits": series["outcomes"].get("cache_hit", 0),
+                    "p50_s": round(self._percentile(recent, 50), 3),
+                    "p95_s": round(self._percentile(recent, 95), 3),
+                    "max_s": round(recent[-1], 3) if recent else 0.0,
+                    "mb_received": round(series["bytes_received"] / (1024 * 1024), 2),
+                    **series["tokens"],
+                })
+        return rows
+
+    def to_json(self) -> str:
+        with self._lock:
+            outcomes = {f"{op}|{model}": dict(series["outcomes"]) for (op, model), series in self._series.items()}
+        return json.dumps({"generated_at": time.time(), "series": self.summary(), "outcomes": outcomes}, indent=2)
+
+    def to_prometheus(self, prefix: str = "nano_banana") -> str:
+        lines = [
+            f"# HELP {prefix}_call_duration_seconds Wall time of instrumented calls.",
+            f"# TYPE {prefix}_call_duration_seconds histogram",
+        ]
+        calls, byte_lines, token_lines = [], [], []
+        with self._lock:
+            for (operation, model), series in sorted(self._series.items()):
+                labels = f'operation="{operation}",model="{model}"'
+                for bound, count in zip(self.BUCKETS, series["bucket_counts"]):
+                    lines.append(f'{prefix}_call_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{prefix}_call_duration_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{prefix}_call_duration_seconds_sum{{{labels}}} {series["sum_seconds"]}')
+                lines.append(f'{prefix}_call_duration_seconds_count{{{labels}}} {series["count"]}')
+                for outcome, count in sorted(series["outcomes"].items()):
+                    calls.append(f'{prefix}_calls_total{{{labels},outcome="{outcome}"}} {count}')
+                byte_lines.append(f'{prefix}_bytes_received_total{{{labels}}} {series["bytes_received"]}')
+                for field, count in series["tokens"].items():
+                    token_lines.append(f'{prefix}_tokens_total{{{labels},kind="{field[:-len("_tokens")]}"}} {count}')
+
+        lines += [f"# HELP {prefix}_calls_total Instrumented calls by outcome.", f"# TYPE {prefix}_calls_total counter"] + calls
+        lines += [f"# HELP {prefix}_bytes_received_total Response payload bytes.", f"# TYPE {prefix}_bytes_received_total counter"] + byte_lines
+        lines += [f"# HELP {prefix}_tokens_total Tokens reported in usage_metadata.", f"# TYPE {prefix}_tokens_total counter"] + token_lines
+        return "\n".join(lines) + "\n"
+
+# HTTP statuses worth retrying; 429 additionally shrinks the concurrency window
+RATE_LIMIT_STATUS_CODES = {429}
+TRANSIENT_STATUS_CODES = {408, 500, 502, 503, 504}
+TRANSIENT_EXCEPTION_NAMES = {"ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout",
+                             "TimeoutException", "RemoteProtocolError", "ReadError"}
+
+def classify_error(e: Exception) -> str:
+    """
+    Returns 'rate_limited', 'transient' or 'fatal' for an exception raised by the API client.
+    """
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    if code in RATE_LIMIT_STATUS_CODES:
+        return "rate_limited"
+    if code in TRANSIENT_STATUS_CODES:
+        return "transient"
+    if isinstance(e, (TimeoutError, ConnectionError)) or type(e).__name__ in TRANSIENT_EXCEPTION_NAMES:
+        return "transient"
+    return "fatal"
+
+CACHED_CONTENT_STATUS_CODES = {400, 403, 404}
+
+def is_cached_content_error(e: Exception) -> bool:
+    # The request was rejected because of its cached-content handle (expired, deleted, wrong model)
+    code = getattr(e, "code", None) or getattr(e, "status_code", None)
+    message = str(e).lower().replace(" ", "").replace("_", "")
+    return code in CACHED_CONTENT_STATUS_CODES and "cachedcontent" in message
+
+def retry_after_seconds(e: Exception) -> Optional[float]:
+    """
+    Extracts a server retry hint: google.rpc.RetryInfo in the error details, or a
+    Retry-After header on the underlying response.
+    """
+    details = getattr(e, "details", None)
+    if isinstance(details, dict):
+        for detail in details.get("error", {}).get("details", []) or []:
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is not None:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+class _AimdLimiter:
+    """
+    Concurrency window for one model: +1/limit per success (about +1 per full
+    window), halved on a rate limit at most once per `decrease_cooldown` seconds.
+    Retry hints pause new requests for the whole model.
+    """
+    def __init__(self, initial: int, min_limit: int, max_limit: int, decrease_cooldown: float = 1.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.throttled = 0
+        self.retries = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, outcome: str, pause_seconds: Optional[float] = None):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.time()
+            if outcome == "success":
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            elif outcome == "rate_limited":
+                self.throttled += 1
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            if pause_seconds:
+                self.paused_until = max(self.paused_until, now + pause_seconds)
+            self._cond.notify_all()
+
+class RequestScheduler:
+    """
+    Runs API calls with retries and adaptive per-model concurrency.
+
+    Rate-limited (429) and transient (5xx, timeouts) errors are retried with
+    full-jitter exponential backoff, or after the server's retry hint when one is
+    given. Each (API key, model) pair has an AIMD concurrency window: it grows
+    additively while calls succeed and halves on rate limits, so batch runs
+    settle at the highest throughput the quota allows. Quotas belong to the key,
+    so one key being throttled never slows down another.
+    """
+    def __init__(self, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 60.0,
+                 initial_concurrency: int = 4, min_concurrency: int = 1, max_concurrency: int = 16):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._limiters: Dict[Tuple[str, str], _AimdLimiter] = {}
+        self._random = random.Random()
+
+    def limiter(self, model_id: str, key_hash: str = "") -> _AimdLimiter:
+        with self._lock:
+            limiter = self._limiters.get((key_hash, model_id))
+            if limiter is None:
+                limiter = _AimdLimiter(self.initial_concurrency, self.min_concurrency, self.max_concurrency)
+                self._limiters[(key_hash, model_id)] = limiter
+            return limiter
+
+    def backoff_delay(self, attempt: int, hint: Optional[float] = None) -> float:
+        if hint is not None:
+            return min(self.max_delay, hint) + self._random.uniform(0, self.base_delay)
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, model_id: str, fn: Callable[..., Any], *args, key_hash: str = "", **kwargs) -> Any:
+        # `key_hash` (ClientRegistry.key_hash) selects the quota the call counts against
+        limiter = self.limiter(model_id, key_hash)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == "fatal" or attempt == self.max_retries:
+                    limiter.release(kind)
+                    raise
+                hint = retry_after_seconds(e)
+                limiter.release(kind, pause_seconds=hint)
+                with self._lock:
+                    limiter.retries += 1
+                delay = self.backoff_delay(attempt, hint)
+                print(f"⏳ {model_id}: {kind} ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            limiter.release("success")
+            return result
+
+    def stats(self, key_hash: str = "") -> Dict[str, Dict[str, Any]]:
+        # Per-model windows for one API key
+        with self._lock:
+            limiters = {model_id: limiter for (owner, model_id), limiter in self._limiters.items() if owner == key_hash}
+        return {
+            model_id: {
+                "limit": round(limiter.limit, 2),
+                "in_flight": limiter.in_flight,
+                "throttled": limiter.throttled,
+                "retries": limiter.retries,
+            }
+            for model_id, limiter in limiters.items()
+        }
+
+BATCH_TERMINAL_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+def batch_state_name(job: Any) -> str:
+    state = getattr(job, "state", None)
+    return getattr(state, "name", None) or str(state)
+
+class BatchJobStore:
+    """
+    Local record of submitted Gemini batch jobs, saved atomically as JSON.
+
+    For each job it keeps the model, the item list in submission order (prompt,
+    output path and log fields) and whether its results were already written to
+    disk, so a later process can poll and materialize the job.
+
+    A submission is recorded under its display name *before* the create call
+    (state SUBMITTING) and moved to the job name afterwards, so a crash in
+    between leaves a record that can be matched against the server's job list.
+    """
+    SUBMITTING = "SUBMITTING"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data: Dict[str, Any] = {"jobs": {}}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _submit_key(display_name: str) -> str:
+        return f"submitting:{display_name}"
+
+    def begin_submit(self, display_name: str, model_id: str, items: List[Dict[str, Any]]):
+        with self._lock:
+            self.data["jobs"][self._submit_key(display_name)] = {
+                "model": model_id,
+                "display_name": display_name,
+                "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "state": self.SUBMITTING,
+                "materialized": False,
+                "items": items,
+            }
+            self._save()
+
+    def finish_submit(self, display_name: str, job_name: str):
+        with self._lock:
+            record = self.data["jobs"].pop(self._submit_key(display_name))
+            record["state"] = "JOB_STATE_PENDING"
+            self.data["jobs"][job_name] = record
+            self._save()
+
+    def discard_submit(self, display_name: str):
+        with self._lock:
+            self.data["jobs"].pop(self._submit_key(display_name), None)
+            self._save()
+
+    def submitting(self) -> List[str]:
+        # Display names of submissions whose create call may or may not have reached the server
+        with self._lock:
+            return [job["display_name"] for job in self.data["jobs"].values() if job["state"] == self.SUBMITTING]
+
+    def update(self, job_name: str, **fields):
+        with self._lock:
+            self.data["jobs"][job_name].update(fields)
+            self._save()
+
+    def get(self, job_name: str) -> Dict[str, Any]:
+        with self._lock:
+            return self.data["jobs"][job_name]
+
+    def pending(self) -> List[str]:
+        # Submitted jobs whose results have not been written to disk yet, whatever their
+        # last known state: non-terminal ones are polled, finished ones just materialized
+        with self._lock:
+            return [name for name, job in self.data["jobs"].items()
+                    if not job["materialized"] and job["state"] != self.SUBMITTING]
 
 class ContentGenerator:
-    def __init__(self, api_key: str, text_model_id: str, image_model_id: str):
+    def __init__(self, api_key: str, text_model_id: str, image_model_id: str,
+                 registry: Optional[ClientRegistry] = None, client: Optional[Any] = None):
         """
         Initializes the Gemini API client.
+        When a registry is given, its shared client for this API key is reused;
+        an explicit `client` (e.g. a local fake) takes precedence over both.
         """
         self.api_key = api_key
         # Check if the exact model ID is accessible or fallback
         self.text_model_id = text_model_id
         self.image_model_id = image_model_id
         self.system_instruction = None # Can be overridden
+        self.image_cache: Optional[ImageCache] = None # Set to enable the on-disk image cache
+        self.prompt_cache: Optional[PromptCache] = None # Set to memoize generate_prompts results
+        self.post_processor: Optional[ImagePostProcessor] = None # Set to build thumbnails after each save
+        self.optimize_images = False # Set to also recompress saved PNGs in the post-processor
+        self.context_cache: Optional[ContextCache] = None # Set to cache the static prompt prefix server-side
+        self.hooks: List[Callable[[Dict[str, Any]], None]] = [] # Called with a record after every instrumented call
+        self.scheduler: Optional[RequestScheduler] = None # Set to retry transient errors with adaptive concurrency
+        self.registry = registry
+
+        if client is not None:
+            self.client = client
+            return
+
+        if registry is not None:
+            self.client = registry.get_client(api_key)
+            return
         
         try:
             # Initialize the new Google GenAI SDK client
@@ -25,123 +1333,230 @@ class ContentGenerator:
             print(f"❌ Error initializing Google GenAI Client: {e}")
             raise e
 
-    def generate_prompts(self, brief: str, guidelines: str) -> List[Dict[str, Any]]:
-        """
-        Generates structured image prompts based on the brief and brand guidelines.
-        """
-        # strict_guidelines = f"BRAND GUIDELINES:\n{guidelines}\n\nSTRICTLY ADHERE TO THESE."
-        
+    def _emit(self, operation: str, model: str, started: float, outcome: str,
+              bytes_received: int = 0, usage_metadata: Any = None):
+        # Reports one call to every registered hook; hooks must never break generation
+        if not self.hooks:
+            return
+        record = {
+            "operation": operation,
+            "model": model,
+            "seconds": time.perf_counter() - started,
+            "outcome": outcome,
+            "bytes_received": bytes_received,
+            "timestamp": time.time(),
+            **usage_fields(usage_metadata),
+        }
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                print(f"⚠️ Metrics hook failed: {e}")
+
+    def _call_model(self, model_id: str, fn: Callable[..., Any], **kwargs) -> Any:
+        # Routes an API call through the scheduler (retries + AIMD) when one is set
+        if self.scheduler is not None:
+            return self.scheduler.call(model_id, fn, key_hash=ClientRegistry.key_hash(self.api_key), **kwargs)
+        return fn(**kwargs)
+
+    def _open_stream(self, **kwargs) -> Iterator[Any]:
+        # The request is only sent when the first chunk is pulled, so that is what gets retried
+        def first_chunk():
+            stream = iter(self.client.models.generate_content_stream(**kwargs))
+            return next(stream, None), stream
+
+        first, stream = self._call_model(kwargs["model"], first_chunk)
+        if first is None:
+            return iter(())
+        return itertools.chain([first], stream)
+
+    def _resolve_system_instruction(self) -> str:
         # Use custom system instruction if provided (from UI), else default
-        if self.system_instruction:
-            system_instruction = self.system_instruction
-        else:
-            system_instruction = """
-        You are an expert Social Media Content Strategist and Creative Director for 'My Kiwi Languages'.
-        Your goal is to translate a client brief into executable image generation prompts.
-
-        *** MASTER PROMPT / VISUAL IDENTITY ***
-        1. THE PROTAGONIST: "Kiwi"
-           - Anthropomorphized, stylized Kiwi bird.
-           - Shape: Ovoid/pear/circular. Long, thin, slightly curved beak (wood/light orange).
-           - Personality: Eternal student, traveler. Adapts to environment (e.g., gaucho beret, Panama hat).
-           - Evolution: 
-             * Flat Version: Dot eyes, flat colors, no black borders.
-             * Storybook Version: Defined ink borders, watercolor/crayon textures, expressive shiny eyes.
-
-        2. ARTISTIC STYLES (DUALITY):
-           - Line A: "Modern/Flat" (Education/Business). Vector style, clean, geometric, negative space. Modern editorial design.
-           - Line B: "Hand-drawn" (Culture/Kids). Children's book illustration. Rough textures, soft brush shading, organic outlines.
-           - Geometry: Friendly curves, no aggressive angles. Rounded corners.
-
-        3. COLOR PALETTE:
-           - Deep Navy (Trust/Authority). Main body color in flat versions.
-           - Cultural Accents: NZ (Black/White/Silver) mixed with Latin American flags (Ecuador: Yellow/Blue/Red; Argentina: Light Blue/White; Peru: Red/White etc).
-           - Backgrounds: Very soft pastels (cream, smoke grey, pale sky blue).
-
-        4. NARRATIVE:
-           - Fusion of NZ and Latin America.
-           - Key Elements: Mate, thermoses, flags, entwined maps, sheep vs llamas, Southern Alps vs Andes.
-           - Scenery: Simplified classrooms, modern offices, minimal rural landscapes.
-
-        *** CRITICAL INSTRUCTION: TEXT RENDERING ***
-        - The Client Brief contains specific text for the image (e.g., "EN: ... / ES: ...").
-        - **YOU MUST INCLUDE THIS TEXT IN THE GENERATED IMAGE PROMPT**.
-        - Format the prompt to explicitly say: "...containing the text: '[Insert EN/ES Text Here]'. The text should be large, clear, and readable."
-
-        Output:
-        A JSON object containing a list of 'posts'.
-        Each 'post' must have:
-        - 'id': sequential number
-        - 'concept': Short title
-        - 'description': Brief explanation
-        - 'options': A list of 3 distinct image prompts strings.
-           * Option 1: "Modern/Flat" Style (Business/Edu focus).
-           * Option 2: "Hand-drawn/Storybook" Style (Culture focus).
-           * Option 3: "Creative Fusion" (A mix or a specific variation requested in brief).
-           * EACH prompt must explicitly describe the Kiwi, the Setting, the Props, and THE TEXT to be rendered.
-        
-        Return ONLY valid JSON.
-
-
-        4. **Text Inclusion (MANDATORY)**:
-           - The Client Brief contains specific text for the image (e.g., "EN: ... / ES: ...").
-           - **YOU MUST INCLUDE THIS TEXT IN THE GENERATED IMAGE PROMPT**.
-           - Format the prompt like this: "A [Style Description] ... containing the text: '[Insert EN/ES Text Here]'. The text should be large, clear, and readable."
-           - If the brief has "EN: Hello / ES: Hola", the prompt MUST explicitly say to include "Hello / Hola".
-
-        Output:
-        A JSON object containing a list of 'posts'.
-        Each 'post' must have:
-        - 'id': sequential number (1, 2, ...)
-        - 'concept': Short title of the post idea.
-        - 'description': Brief explanation of the post content.
-        - 'options': A list of 3 distinct image prompts.
-            - **IMPORTANT**: This must be a simple List of STRINGS. Do not use objects/dictionaries for the prompts.
-            - **CRITICAL**: Each string MUST end with strict text rendering instructions if text is required by the brief.
-            - Example: "A watercolor kiwi reading a book. The text 'Classroom' is written on the cover."
-        
-        Return ONLY valid JSON.
+        return compact_prompt_text(self.system_instruction or DEFAULT_SYSTEM_INSTRUCTION)
+
+    def _build_prompt(self, system_instruction: str, guidelines: str, brief: str) -> str:
+        return "\n\n".join([
+            system_instruction,
+            f"BRAND GUIDELINES:\n{guidelines.strip()}",
+            f"CLIENT BRIEF:\n{brief.strip()}"
+        ])
+
+    def _text_request(self, system_instruction: str, guidelines: str, brief: str,
+                      use_context_cache: bool = True) -> Tuple[str, Any, Optional[str]]:
         """
-        
-        full_prompt = f"""
-        {system_instruction}
-        
-        BRAND GUIDELINES:
-        {guidelines}
-        
-        CLIENT BRIEF:
-        {brief}
+        Returns (contents, config, cached_content_name) for a prompt request.
+        With a live context cache only the brief is sent; the static prefix
+        (system instruction + guidelines) is referenced by its cache handle.
         """
-        
-        try:
-            response = self.client.models.generate_content(
-                model=self.text_model_id,
-                contents=full_prompt,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json"
-                )
+        cached_name = None
+        if use_context_cache and self.context_cache is not None:
+            cached_name = self.context_cache.get_or_create(self.client, self.text_model_id, system_instruction, guidelines,
+                                                           ClientRegistry.key_hash(self.api_key))
+
+        if cached_name is not None:
+            contents = f"CLIENT BRIEF:\n{brief.strip()}"
+            config = types.GenerateContentConfig(
+                cached_content=cached_name,
+                response_mime_type="application/json"
             )
-            return json.loads(response.text)
-        except Exception as e:
-            # Fallback to list models if 404
-            available = []
-            try:
+        else:
+            contents = self._build_prompt(system_instruction, guidelines, brief)
+            config = types.GenerateContentConfig(
+                response_mime_type="application/json"
+            )
+        return contents, config, cached_name
+
+    def _text_api_error(self, e: Exception) -> Exception:
+        if classify_error(e) != "fatal":
+            # Quota/availability problem, not a wrong model id: listing models won't help
+            return Exception(f"Gemini API (Text) is busy or rate-limited, please try again in a minute: {e}")
+
+        # Fallback to list models if 404
+        available = []
+        try:
+            if self.registry is not None:
+                # Cached catalog, avoids paginating the whole list on every failure
+                available = list(self.registry.list_models(self.api_key))
+            else:
                 # Listing models in new SDK
                 # It returns an iterator of Model objects
                 pager = self.client.models.list()
                 for m in pager:
                     available.append(m.name)
-            except:
-                available = ["Could not list models"]
-            
-            # If the list is huge, truncate
-            if len(available) > 50:
-                 available = available[:50] + ["... more ..."]
+        except:
+            available = ["Could not list models"]
+        
+        # If the list is huge, truncate
+        if len(available) > 50:
+             available = available[:50] + ["... more ..."]
+
+        error_msg = f"Error calling Gemini API (Text): {e}\n\nAVAILABLE MODELS:\n" + "\n".join(available)
+        return Exception(error_msg)
+
+    def _store_prompts(self, cache_key: Optional[str], result: Dict[str, Any]):
+        if cache_key is not None:
+            try:
+                self.prompt_cache.put(cache_key, result)
+            except OSError as e:
+                print(f"⚠️ Could not store prompts in cache: {e}")
+
+    def _prompt_cache_lookup(self, system_instruction: str, guidelines: str, brief: str,
+                             force_refresh: bool) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        # Identical requests are answered from the memo cache unless a refresh is forced
+        if self.prompt_cache is None:
+            return None, None
+        cache_key = self.prompt_cache.make_key(self.text_model_id, system_instruction, guidelines, brief)
+        if force_refresh:
+            return cache_key, None
+        return cache_key, self.prompt_cache.get(cache_key)
+
+    def generate_prompts(self, brief: str, guidelines: str, force_refresh: bool = False) -> List[Dict[str, Any]]:
+        """
+        Generates structured image prompts based on the brief and brand guidelines.
+        Set `force_refresh` to bypass the prompt memo cache.
+        """
+        # strict_guidelines = f"BRAND GUIDELINES:\n{guidelines}\n\nSTRICTLY ADHERE TO THESE."
+        
+        started = time.perf_counter()
+        system_instruction = self._resolve_system_instruction()
+        cache_key, cached = self._prompt_cache_lookup(system_instruction, guidelines, brief, force_refresh)
+        if cached is not None:
+            self._emit("generate_prompts", self.text_model_id, started, "cache_hit")
+            return cached
+        
+        for use_context_cache in (True, False):
+            contents, config, cached_name = self._text_request(system_instruction, guidelines, brief, use_context_cache)
+            try:
+                response = self._call_model(
+                    self.text_model_id,
+                    self.client.models.generate_content,
+                    model=self.text_model_id,
+                    contents=contents,
+                    config=config
+                )
+                result = json.loads(response.text)
+                self._emit("generate_prompts", self.text_model_id, started, "success",
+                           len(response.text.encode("utf-8")), response.usage_metadata)
+                break
+            except Exception as e:
+                if cached_name is not None and is_cached_content_error(e):
+                    # The handle expired or was deleted server-side; retry once with the prefix inline
+                    self.context_cache.invalidate(cached_name, self.client)
+                    continue
+                self._emit("generate_prompts", self.text_model_id, started, "error")
+                raise self._text_api_error(e)
 
-            error_msg = f"Error calling Gemini API (Text): {e}\n\nAVAILABLE MODELS:\n" + "\n".join(available)
-            raise Exception(error_msg)
+        self._store_prompts(cache_key, result)
+        return result
 
-    def generate_image(self, prompt: str, output_path: str, aspect_ratio: str = "1:1"):
+    def generate_prompts_stream(self, brief: str, guidelines: str, force_refresh: bool = False) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming variant of generate_prompts. Yields each post dict as soon as
+        its JSON object is complete in the response stream, so callers can show
+        the first posts while the rest are still being written.
+        """
+        started = time.perf_counter()
+        system_instruction = self._resolve_system_instruction()
+        cache_key, cached = self._prompt_cache_lookup(system_instruction, guidelines, brief, force_refresh)
+        if cached is not None:
+            self._emit("generate_prompts_stream", self.text_model_id, started, "cache_hit")
+            yield from cached.get('posts', [])
+            return
+
+        yielded = 0
+        for use_context_cache in (True, False):
+            contents, config, cached_name = self._text_request(system_instruction, guidelines, brief, use_context_cache)
+            parser = IncrementalPostParser()
+            chunks = []
+            usage_metadata = None
+            try:
+                stream = self._open_stream(
+                    model=self.text_model_id,
+                    contents=contents,
+                    config=config
+                )
+                for chunk in stream:
+                    text = chunk.text or ""
+                    chunks.append(text)
+                    # Usage is reported on the final chunk(s)
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    for post in parser.feed(text):
+                        yielded += 1
+                        yield post
+
+                full_text = "".join(chunks)
+                result = json.loads(full_text)
+                self._emit("generate_prompts_stream", self.text_model_id, started, "success",
+                           len(full_text.encode("utf-8")), usage_metadata)
+                break
+            except Exception as e:
+                if cached_name is not None and yielded == 0 and is_cached_content_error(e):
+                    # The handle expired or was deleted server-side; retry once with the prefix inline
+                    self.context_cache.invalidate(cached_name, self.client)
+                    continue
+                self._emit("generate_prompts_stream", self.text_model_id, started, "error")
+                raise self._text_api_error(e)
+
+        if isinstance(result, list):
+            result = {'posts': result}
+
+        # Emit anything the incremental parser could not pick up on the way
+        for post in result.get('posts', [])[yielded:]:
+            yield post
+
+        self._store_prompts(cache_key, result)
+
+    def _after_save(self, output_path: str):
+        # Hand off derived work (thumbnails, optimization) to the background pool
+        if self.post_processor is not None:
+            try:
+                self.post_processor.submit_thumbnail(output_path)
+                if self.optimize_images:
+                    self.post_processor.submit_optimize(output_path)
+            except Exception as e:
+                print(f"⚠️ Could not schedule image post-processing: {e}")
+
+    def generate_image(self, prompt: str, output_path: str, aspect_ratio: str = "1:1", image_size: str = "1K"):
         # Generates an image using Gemini image generation models.
         # Supports custom aspect ratios (1:1, 16:9, 9:16, 3:2, 2:3, etc.)
         # Ensure prompt is a string, handling dictionary inputs gracefully
@@ -150,15 +1565,58 @@ class ContentGenerator:
         elif not isinstance(prompt, str):
             prompt = str(prompt)
 
+        return self._render_image("generate_image", prompt, prompt, output_path, aspect_ratio, image_size)
+
+    def edit_image(self, source_path: str, correction: str, output_path: str,
+                   aspect_ratio: str = "1:1", image_size: str = "1K"):
+        """
+        Image-conditioned regeneration: sends the existing image at `source_path`
+        together with the correction, so the model edits it instead of drawing a
+        new image from scratch. Returns (success, message) like generate_image.
+        """
+        try:
+            with open(source_path, "rb") as f:
+                source_bytes = f.read()
+        except OSError as e:
+            return False, f"Error generating image: could not read the image to edit ({e})"
+        extension = os.path.splitext(source_path)[1].lower().replace(".jpeg", ".jpg")
+        mime_type = next((mime for mime, ext in MIME_EXTENSIONS.items() if ext == extension), "image/png")
+
+        instruction = EDIT_INSTRUCTION.format(correction=correction.strip()).strip()
+        contents = [types.Part.from_bytes(data=source_bytes, mime_type=mime_type), instruction]
+        # The cache key covers the source image too, not just the instruction
+        cache_prompt = f"{instruction}\n[source:{hashlib.sha256(source_bytes).hexdigest()}]"
+        return self._render_image("edit_image", contents, cache_prompt, output_path, aspect_ratio, image_size)
+
+    def _render_image(self, operation: str, contents: Any, cache_prompt: str, output_path: str,
+                      aspect_ratio: str, image_size: str):
+        # Shared request/save path for generate_image and edit_image
+        started = time.perf_counter()
+
+        # Serve identical requests from the on-disk cache without a network call
+        cache_key = None
+        if self.image_cache is not None:
+            cache_key = self.image_cache.make_key(self.image_model_id, cache_prompt, aspect_ratio, image_size)
+            try:
+                if self.image_cache.get(cache_key, output_path):
+                    self._emit(operation, self.image_model_id, started, "cache_hit")
+                    self._after_save(output_path)
+                    return True, "Image served from cache"
+            except OSError:
+                pass
+
+        save_started = None
         try:
-            response = self.client.models.generate_content(
+            response = self._call_model(
+                self.image_model_id,
+                self.client.models.generate_content,
                 model=self.image_model_id,
-                contents=prompt,
+                contents=contents,
                 config=types.GenerateContentConfig(
                     response_modalities=["IMAGE"],
                     image_config=types.ImageConfig(
                         aspect_ratio=aspect_ratio,
-                        image_size="1K"
+                        image_size=image_size
                     )
                 )
             )
@@ -166,17 +1624,226 @@ class ContentGenerator:
             # The image is returned as inline_data in the response parts
             for part in response.parts:
                 if part.inline_data is not None:
-                    # Convert to PIL Image and save
-                    image = part.as_image()
-                    
-                    # Ensure directory exists
-                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-                    
-                    image.save(output_path)
+                    self._emit(operation, self.image_model_id, started, "success",
+                               len(part.inline_data.data), response.usage_metadata)
+
+                    # Write the encoded bytes as delivered; no PIL decode/re-encode
+                    save_started = time.perf_counter()
+                    save_image_bytes(part.inline_data.data, part.inline_data.mime_type, output_path)
+                    self._emit("save_image", "disk", save_started, "success", len(part.inline_data.data))
+
+                    if cache_key is not None:
+                        try:
+                            self.image_cache.put(cache_key, output_path)
+                        except OSError as e:
+                            print(f"⚠️ Could not store image in cache: {e}")
+                    self._after_save(output_path)
                     return True, "Image generated successfully"
             
+            self._emit(operation, self.image_model_id, started, "no_image",
+                       usage_metadata=response.usage_metadata)
             return False, "No image data in response"
 
         except Exception as e:
+            if save_started is None:
+                self._emit(operation, self.image_model_id, started, "error")
+            else:
+                # The model call was already reported as a success; only the save failed
+                self._emit("save_image", "disk", save_started, "error")
+            if classify_error(e) != "fatal":
+                return False, f"Error generating image: the API is busy or rate-limited, retries exhausted ({e}). Try again in a minute."
             import traceback
             return False, f"Error generating image: {traceback.format_exc()}"
+
+    def submit_image_batch(self, items: List[Dict[str, Any]], store: BatchJobStore, display_name: Optional[str] = None,
+                           aspect_ratio: str = "1:1", image_size: str = "1K") -> str:
+        """
+        Submits many image prompts as a single Gemini batch job and records it in `store`.
+
+        Each item needs 'prompt' and 'output_path'; any other keys (brief, post id,
+        option number...) are kept for the generation log. Returns the job name.
+        """
+        requests = [
+            {
+                "contents": [{"parts": [{"text": item['prompt']}], "role": "user"}],
+                "config": {
+                    "response_modalities": ["IMAGE"],
+                    "image_config": {"aspect_ratio": aspect_ratio, "image_size": image_size},
+                },
+            }
+            for item in items
+        ]
+        display_name = display_name or f"nano-banana-{datetime.now().strftime('%Y%m%d%H%M%S')}-{random.getrandbits(32):08x}"
+        store.begin_submit(display_name, self.image_model_id, items)
+        # Not idempotent: a retry after a timeout could create (and bill) a second job,
+        # so it bypasses the scheduler. recover_batch_submissions resolves failures.
+        job = self.client.batches.create(
+            model=self.image_model_id,
+            src=requests,
+            config={"display_name": display_name}
+        )
+        store.finish_submit(display_name, job.name)
+        return job.name
+
+    def recover_batch_submissions(self, store: BatchJobStore) -> List[str]:
+        """
+        Resolves submissions interrupted around the create call: jobs found on the
+        server by display name are attached to their record, the others are
+        dropped so their items get submitted again. Returns the recovered job names.
+        """
+        display_names = store.submitting()
+        if not display_names:
+            return []
+        remote = {getattr(job, "display_name", None): job.name for job in self.client.batches.list()}
+        recovered = []
+        for display_name in display_names:
+            if display_name in remote:
+                store.finish_submit(display_name, remote[display_name])
+                recovered.append(remote[display_name])
+            else:
+                store.discard_submit(display_name)
+        return recovered
+
+    def wait_for_batch(self, job_name: str, store: BatchJobStore, poll_interval: float = 30.0,
+                       max_poll_interval: float = 300.0, timeout: Optional[float] = None) -> Any:
+        """
+        Polls a batch job until it reaches a terminal state, backing off between polls.
+        Raises TimeoutError if `timeout` seconds pass first.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        interval = poll_interval
+        while True:
+            job = self._call_model(self.image_model_id, self.client.batches.get, name=job_name)
+            state = batch_state_name(job)
+            if state != store.get(job_name)["state"]:
+                store.update(job_name, state=state)
+            if state in BATCH_TERMINAL_STATES:
+                return job
+            if deadline is not None and time.time() + interval > deadline:
+                raise TimeoutError(f"Batch job {job_name} still {state}")
+            time.sleep(interval)
+            interval = min(max_poll_interval, interval * 1.5)
+
+    def materialize_batch(self, job: Any, store: BatchJobStore,
+                          generation_log: Optional[GenerationLog] = None) -> Tuple[List[Dict[str, Any]], List[Tuple[Dict[str, Any], str]]]:
+        """
+        Writes the images of a finished batch job to their output paths and logs them.
+        Returns (saved_items, [(failed_item, reason), ...]).
+        """
+        record = store.get(job.name)
+        items = record["items"]
+        saved, failed = [], []
+        if batch_state_name(job) != "JOB_STATE_SUCCEEDED":
+            failed = [(item, f"Batch job ended as {batch_state_name(job)}") for item in items]
+            store.update(job.name, materialized=True)
+            return saved, failed
+
+        responses = list(getattr(getattr(job, "dest", None), "inlined_responses", None) or [])
+        for index, item in enumerate(items):
+            inlined = responses[index] if index < len(responses) else None
+            if inlined is None or getattr(inlined, "error", None):
+                failed.append((item, str(getattr(inlined, "error", None) or "Missing response")))
+                continue
+
+            image_part = next((part for part in (inlined.response.parts or []) if part.inline_data is not None), None)
+            if image_part is None:
+                failed.append((item, "No image data in response"))
+                continue
+
+            save_image_bytes(image_part.inline_data.data, image_part.inline_data.mime_type, item['output_path'])
+            self._after_save(item['output_path'])
+            if generation_log is not None:
+                generation_log.append({
+                    "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    **{field: item.get(field, "") for field in LOG_FIELDS if field not in ("date", "file_path")},
+                    "file_path": item['output_path'],
+                    "batch_job": job.name,
+                })
+            saved.append(item)
+
+        store.update(job.name, materialized=True)
+        return saved, failed
+
+    def generate_images(self, jobs: Iterable[Dict[str, Any]], max_workers: int = 4) -> Iterator[Tuple[Any, bool, str]]:
+        """
+        Generates several images concurrently, yielding results as they complete.
+
+        Each job is a dict with 'key', 'prompt', 'output_path' and optionally
+        'aspect_ratio'. Yields (key, success, message) tuples in completion order,
+        so callers can update the UI progressively. At most `max_workers`
+        requests are in flight at any time.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(jobs))))
+        try:
+            futures = {
+                executor.submit(
+                    self.generate_image,
+                    job['prompt'],
+                    job['output_path'],
+                    job.get('aspect_ratio', "1:1")
+                ): job['key']
+                for job in jobs
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    success, msg = future.result()
+                except Exception as e:
+                    success, msg = False, f"Error generating image: {e}"
+                yield key, success, msg
+        finally:
+            # On Ctrl-C or when the caller stops iterating, queued jobs are dropped;
+            # only the requests already in flight are waited for
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def derive_formats(self, master_path: str, prompt: str, aspect_ratios: Iterable[str],
+                       api_fallback: bool = False, max_workers: int = 4,
+                       max_lost_text: float = 0.0) -> Iterator[Tuple[str, bool, str, str]]:
+        """
+        Produces other aspect ratios of a generated image locally (smart crop or
+        padding on the brand background), in the post-processor's worker pool
+        when one is set.
+
+        With `api_fallback`, formats whose crop would cut more than `max_lost_text`
+        of the rendered text are generated by the image model from `prompt`
+        instead of padded. Yields
+        (aspect_ratio, success, message, output_path) in completion order.
+        """
+        mode = "crop" if api_fallback else "auto"
+        pending = {}
+        for aspect_ratio in aspect_ratios:
+            output_path = derived_image_path(master_path, aspect_ratio)
+            if self.post_processor is not None:
+                future = self.post_processor.submit_derive(master_path, output_path, aspect_ratio, mode, max_lost_text)
+            else:
+                future = Future()
+                try:
+                    future.set_result(derive_aspect_ratio(master_path, output_path, aspect_ratio, mode,
+                                                          max_lost_text=max_lost_text))
+                except Exception as e:
+                    future.set_exception(e)
+            pending[future] = (aspect_ratio, output_path, time.perf_counter())
+
+        api_jobs = []
+        for future in as_completed(pending):
+            aspect_ratio, output_path, started = pending[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                self._emit("derive_image", "local", started, "error")
+                yield aspect_ratio, False, f"Error deriving image: {e}", output_path
+                continue
+            if status == "needs_api":
+                api_jobs.append({'key': aspect_ratio, 'prompt': prompt, 'output_path': output_path, 'aspect_ratio': aspect_ratio})
+                continue
+            self._emit("derive_image", "local", started, status)
+            self._after_save(output_path)
+            yield aspect_ratio, True, "Cropped" if status == "cropped" else "Padded", output_path
+
+        # Only the formats that cannot be cropped cleanly cost an API call
+        for aspect_ratio, success, msg in self.generate_images(api_jobs, max_workers=max_workers):
+            yield aspect_ratio, success, msg, derived_image_path(master_path, aspect_ratio)